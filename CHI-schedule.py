@@ -8,31 +8,14 @@ import time
 import cyautomation.cyschoolhouse as cysh
 
 def m_tu_w_th_scripts():
-    ## sync enrollment in DESSA sections
-    result = cysh.student_section.enrollment_sync(
-        source_section = 'Tutoring: Math',
-        destination_section = 'DESSA',
-        enrollment_start_date = '2018-09-05',
-        ACM_to_TL = True
-    )
-
-    result = cysh.student_section.enrollment_sync(
-        source_section = 'Tutoring: Literacy',
-        destination_section = 'DESSA',
-        enrollment_start_date = '2018-09-05',
-        ACM_to_TL = True
-    )
-
-    ## sync enrollment in MIRI sections
-    result = cysh.student_section.enrollment_sync(
-        source_section = 'Tutoring: Math',
-        destination_section = 'Math Inventory',
-        enrollment_start_date = '2018-09-05'
-    )
-
-    result = cysh.student_section.enrollment_sync(
-        source_section = 'Tutoring: Literacy',
-        destination_section = 'Reading Inventory',
+    ## sync enrollment in DESSA and MIRI sections
+    result = cysh.student_section.enrollment_sync_many(
+        pairs = [
+            ('Tutoring: Math', 'DESSA', True),
+            ('Tutoring: Literacy', 'DESSA', True),
+            ('Tutoring: Math', 'Math Inventory'),
+            ('Tutoring: Literacy', 'Reading Inventory'),
+        ],
         enrollment_start_date = '2018-09-05'
     )
 
@@ -1,48 +1,39 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
-import sys
-from time import sleep
 
 from pandas import read_excel
-from seleniumrequests import Firefox
 from selenium.common.exceptions import (
-    NoSuchElementException, StaleElementReferenceException, TimeoutException
+    StaleElementReferenceException, TimeoutException
 )
-from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 
 from . import pages as page
-from ..config import (
-    INPUT_PATH, OKTA_USER, OKTA_PASS, SF_USER, SF_PASS, TEMP_PATH
-)
-
-GECKO_PATH = str(Path(__file__).parents[3] / 'geckodriver/geckodriver.exe')
+from ..browser_pool import BrowserPool
+from ..cyschoolhousesuite import get_driver
+from ..config import INPUT_PATH, OKTA_USER, OKTA_PASS
 
 
 class BaseImplementation(object):
     """Base Implementation object
 
     It's an important feature of every implementation that it either take an
-    existing driver or be capable of starting one
+    existing driver or be capable of starting one. The browser is only
+    started when the driver is first used.
     """
     def __init__(self, driver=None):
-        if driver == None:
-            self.driver  = self.get_driver()
-        else:
-            self.driver = driver
-
-    def get_driver(self):
-        profile = FirefoxProfile()
-        profile.set_preference('browser.download.folderList', 2)
-        profile.set_preference('browser.download.manager.showWhenStarting', False)
-        profile.set_preference('browser.download.dir', TEMP_PATH)
-        profile.set_preference('browser.helperApps.neverAsk.saveToDisk',
-                               ('application/csv,text/csv,application/vnd.ms-excel,'
-                                'application/x-msexcel,application/excel,'
-                                'application/x-excel,text/comma-separated-values'))
-
-        driver = Firefox(firefox_profile=profile,
-                         executable_path=GECKO_PATH)
-        return driver
+        self._driver = driver
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = self.get_driver()
+        return self._driver
+
+    @driver.setter
+    def driver(self, driver):
+        self._driver = driver
+
+    def get_driver(self, headless=False, profile='default'):
+        return get_driver(headless=headless, profile=profile)
 
 
 class Okta(BaseImplementation):
@@ -50,8 +41,8 @@ class Okta(BaseImplementation):
 
     Wraps all processes for logging into Okta and navigation.
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, driver=None):
+        super().__init__(driver)
         self.user = OKTA_USER
         self.pwd = OKTA_PASS
 
@@ -91,10 +82,12 @@ class Okta(BaseImplementation):
 class IndicatorAreaEnrollment(Okta):
     """Implementation object for Indicator Area Enrollment"""
 
-    def __init__(self):
-        super().__init__()
-        xl_path = str(Path(INPUT_PATH) / 'indicator_area_roster.xlsx')
-        self.data = read_excel(xl_path)
+    def __init__(self, driver=None, data=None):
+        super().__init__(driver)
+        if data is None:
+            xl_path = str(Path(INPUT_PATH) / 'indicator_area_roster.xlsx')
+            data = read_excel(xl_path)
+        self.data = data
 
     @property
     def student_list(self):
@@ -110,6 +103,10 @@ class IndicatorAreaEnrollment(Okta):
         cysh_home = page.CyshHomePage(self.driver)
         assert cysh_home.page_is_loaded()
 
+        self.reload_form()
+
+    def reload_form(self):
+        """Loads a blank IA enrollment form, discarding any unsaved input"""
         self.driver.get("https://c.na24.visual.force.com/apex/IM_Indicator_Areas")
         ia_form = page.CyshIndicatorAreas(self.driver)
         ia_form.wait_for_page_to_load()
@@ -142,8 +139,19 @@ class IndicatorAreaEnrollment(Okta):
 
         ia_form.save()
 
-    def enroll_all_students(self, max_errors=5):
-        """Executes the full IA enrollment"""
+    def enroll_all_students(self, max_errors=5, n_workers=1,
+                            profile='default'):
+        """Executes the full IA enrollment
+
+        n_workers: students to enroll at once, each worker in its own headless
+                   browser. `max_errors` applies to the serial run only; with
+                   several workers, failed students are retried once and
+                   returned in the report.
+        profile: driver profile of the workers, see `get_driver`
+        """
+        if n_workers > 1:
+            return self._enroll_all_students_pool(n_workers, profile)
+
         self.nav_to_form()
         self.error_count = 0
         for student_id in self.student_list:
@@ -167,3 +175,25 @@ class IndicatorAreaEnrollment(Okta):
             except Exception as e:
                 print(f"Error on student {student_id}: {e}")
                 self.error_count += 1
+
+    def _enroll_all_students_pool(self, n_workers, profile):
+        def start_session():
+            worker = IndicatorAreaEnrollment(
+                driver=self.get_driver(headless=True, profile=profile),
+                data=self.data
+            )
+            worker.nav_to_form()
+            return worker
+
+        # A failed student may leave the form half filled, so a retry starts
+        # from a freshly loaded form
+        pool = BrowserPool(n_workers, start_session=start_session,
+                           on_error=lambda worker: worker.reload_form())
+        report = pool.map(
+            lambda worker, student_id: worker.enroll_student(student_id),
+            self.student_list
+        )
+        for _, row in report.loc[~report['success']].iterrows():
+            print(f"Error on student {row['item']}: {row['error']}")
+
+        return report
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-from time import sleep
-
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.webdriver.common.by import By
@@ -8,6 +6,7 @@ from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
 from . import locators as loc
 from . import elements as elem
+from ..waits import wait_for, wait_page_settled
 
 SF_URL = ('https://cityyear.okta.com/home/salesforce/'
           '0oa19u4wnhzgPqjtw0h8/46?fromHome=true')
@@ -82,21 +81,21 @@ class CyshIndicatorAreas(BasePage):
         )
         selector = Select(self.driver.find_element(*loc.IndicatorAreaLocators.SCHOOL_SELECT))
         selector.select_by_visible_text(school_name)
-        sleep(0.75)
+        wait_page_settled(self.driver, 'ia.school')
 
     def select_grade(self, grade):
         """Updates the school selector to the given school name"""
         WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable(loc.IndicatorAreaLocators.GRADE_SELECT))
         selector = Select(self.driver.find_element(*loc.IndicatorAreaLocators.GRADE_SELECT))
         selector.select_by_visible_text(grade)
-        sleep(0.75)
+        wait_page_settled(self.driver, 'ia.grade')
 
     def select_first_page(self):
         """Start from the first page"""
         first_page = self.driver.find_elements(By.LINK_TEXT, 'First')
         if first_page:
             first_page[0].click()
-            sleep(0.5)
+            wait_page_settled(self.driver, 'ia.first_page')
 
     def select_student(self, student_id):
         """Selects a visible student using their Salesforce Id
@@ -116,16 +115,18 @@ class CyshIndicatorAreas(BasePage):
         except TimeoutException:
             try:
                 self.driver.find_element(By.LINK_TEXT, 'Next').click()
-                sleep(0.5)
+                wait_page_settled(self.driver, 'ia.next_page')
             except NoSuchElementException:
                 raise Exception('Student not found')
 
             return self.select_student(student_id)
 
         self.driver.find_element(By.CSS_SELECTOR, f"tr[id ^= '{student_id}'] td").click()
-        sleep(0.5)
-        WebDriverWait(self.driver, 10).until(
-            EC.element_to_be_clickable(loc.IndicatorAreaLocators.ADD_TO_IA_BUTTON)
+        wait_page_settled(self.driver, 'ia.student')
+        wait_for(
+            self.driver,
+            EC.element_to_be_clickable(loc.IndicatorAreaLocators.ADD_TO_IA_BUTTON),
+            'ia.add_to_ia_button', timeout=10
         )
         self.driver.find_element(*loc.IndicatorAreaLocators.ADD_TO_IA_BUTTON).click()
 
@@ -138,8 +139,11 @@ class CyshIndicatorAreas(BasePage):
         }
         WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable(ia_dict[ia]))
         self.driver.find_element(*ia_dict[ia]).click()
-        sleep(0.25)
-        self.driver.find_element(*loc.IndicatorAreaLocators.ADD_IA_BUTTON).click()
+        wait_for(
+            self.driver,
+            EC.element_to_be_clickable(loc.IndicatorAreaLocators.ADD_IA_BUTTON),
+            'ia.add_ia_button', timeout=10
+        ).click()
         WebDriverWait(self.driver, 10).until(EC.invisibility_of_element_located(loc.IndicatorAreaLocators.IA_WINDOW))
 
     def save(self):
@@ -1,11 +1,14 @@
+import multiprocessing
+
 from .cyschoolhousesuite import open_cyschoolhouse
-from . import section_creation, student, student_section
-from .config import USER_SITE
+from . import (browser_pool, change_feed, replica, reports,
+               section_creation, student, student_section, waits)
+from .config import MAP_SHAREPOINT_DRIVE, USER_SITE
 from .simple_cysh import (get_object_df, get_object_fields, get_section_df,
                           get_staff_df, get_student_df,
                           get_student_section_staff_df, init_sf_session,
                           object_reference, sf, soql_query_as_df)
-from .section_creation import Section, Sections
+from .section_creation import Section, SectionIndex, Sections
 from .utils import map_sharepoint_drive, get_sch_ref_df
 
 if USER_SITE.lower() == 'chicago':
@@ -16,4 +19,7 @@ if USER_SITE.lower() == 'chicago':
     from .trackers import (AttendanceTracker, CoachingLog,
                            LeadershipTracker, WeeklyServiceTracker)
 
-map_sharepoint_drive()
+# Worker processes re-import the package, and remapping there would drop Z:
+# under the parent while it is writing to it
+if MAP_SHAREPOINT_DRIVE and multiprocessing.parent_process() is None:
+    map_sharepoint_drive()
@@ -0,0 +1,168 @@
+"""Browser Pool
+Runs bulk Selenium jobs over several logged-in browsers at once. Each worker
+thread owns one browser session and takes items from a shared queue; items
+that fail are retried, and a worker whose browser dies starts a new one.
+
+    pool = BrowserPool(n_workers=4)
+    report = pool.map(lambda driver, section: section.create(driver),
+                      sections)
+"""
+import logging
+import queue
+import threading
+from functools import partial
+from time import monotonic
+
+import pandas as pd
+from selenium.common.exceptions import WebDriverException
+
+from .browser_service import lease_driver
+
+
+def start_cyschoolhouse_session(profile='default'):
+    """ Default session: a browser logged in to cyschoolhouse, leased from
+    the browser service when it is running
+    """
+    return lease_driver(profile)
+
+
+def stop_driver_session(session):
+    getattr(session, 'driver', session).quit()
+
+
+class BrowserPool:
+    def __init__(self, n_workers=2, start_session=None,
+                 stop_session=stop_driver_session, max_retries=1,
+                 on_error=None, profile='default'):
+        """
+        n_workers: number of browser sessions to run at once
+        start_session: returns a new, ready session; either a driver or an
+                       object with a `driver` attribute. Defaults to a
+                       cyschoolhouse login with the `profile` driver profile
+        stop_session: closes a session
+        max_retries: times a failed item is put back on the queue
+        on_error: optional `on_error(session)` called after an item fails on
+                  a live browser, e.g. to navigate back to a known page
+        """
+        self.n_workers = n_workers
+        self.start_session = (start_session or
+                              partial(start_cyschoolhouse_session, profile))
+        self.stop_session = stop_session
+        self.max_retries = max_retries
+        self.on_error = on_error
+
+    def map(self, func, items):
+        """ Calls `func(session, item)` for every item across the pool.
+
+        Returns a DataFrame with one row per item, in input order, with
+        columns item, success, result, error, attempts, worker and seconds.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        work = queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item, 1))
+
+        workers = [
+            threading.Thread(target=self._work,
+                             args=(n, func, work, results),
+                             name=f'browser-{n}', daemon=True)
+            for n in range(min(self.n_workers, len(items)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # Items left when every worker gave up on starting a browser
+        while not work.empty():
+            i, item, attempts = work.get()
+            results[i] = self._result(item, False, error='No browser session',
+                                      attempts=attempts - 1)
+
+        report = pd.DataFrame(results, columns=['item', 'success', 'result',
+                                                'error', 'attempts', 'worker',
+                                                'seconds'])
+        logging.info(f"Browser pool finished {report['success'].sum()} of "
+                     f"{len(report)} items with {len(workers)} workers")
+
+        return report
+
+    def _work(self, n, func, work, results):
+        session = self._start(n)
+        if session is None:
+            return
+
+        while True:
+            try:
+                i, item, attempts = work.get_nowait()
+            except queue.Empty:
+                break
+
+            start = monotonic()
+            try:
+                result = func(session, item)
+                results[i] = self._result(item, True, result=result,
+                                          attempts=attempts, worker=n,
+                                          seconds=monotonic() - start)
+                continue
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                error = e
+
+            logging.warning(f'Worker {n} failed on {item!r} '
+                            f'(attempt {attempts}): {error}')
+
+            if not self._is_alive(session):
+                logging.warning(f'Worker {n} lost its browser, restarting')
+                self._stop(session)
+                session = self._start(n)
+            elif self.on_error:
+                try:
+                    self.on_error(session)
+                except Exception:
+                    logging.exception(f'Worker {n} failed to recover')
+
+            if attempts <= self.max_retries:
+                work.put((i, item, attempts + 1))
+            else:
+                results[i] = self._result(item, False, error=repr(error),
+                                          attempts=attempts, worker=n,
+                                          seconds=monotonic() - start)
+
+            if session is None:
+                return
+
+        self._stop(session)
+
+    def _start(self, n):
+        for attempt in range(1 + self.max_retries):
+            try:
+                return self.start_session()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:
+                logging.exception(f'Worker {n} could not start a browser')
+        return None
+
+    def _stop(self, session):
+        try:
+            self.stop_session(session)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            getattr(session, 'driver', session).current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _result(item, success, result=None, error=None, attempts=1,
+                worker=None, seconds=None):
+        return {'item': item, 'success': success, 'result': result,
+                'error': error, 'attempts': attempts, 'worker': worker,
+                'seconds': seconds}
@@ -0,0 +1,518 @@
+"""Browser Service
+A local daemon that keeps logged-in Firefox sessions warm and lends them to
+jobs, so scheduled scripts skip browser launch and login. Start it once:
+
+    python -m cyautomation.cyschoolhouse.browser_service --warm 2
+
+and jobs lease drivers from it. A leased driver is attached to the warm
+session over the WebDriver protocol; `quit()` hands it back instead of
+closing it. When the service is not running, `lease_driver` starts and logs
+in a local browser as before.
+
+    driver = lease_driver()
+    driver.get(f'{SF_URL}/apex/IM_AddStudentsToPrograms')
+    driver.quit()
+
+The service checks idle sessions are still logged in, signs them back in
+with the API session when they are not, and replaces sessions that die,
+fail a check, get too old or have been lent too often.
+
+Requests must carry the BROWSER_SERVICE_TOKEN from .env, which the service
+needs to start; without one, jobs start their own browsers.
+"""
+import argparse
+import hmac
+import json
+import logging
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import urlparse
+
+import requests
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver import Remote
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+from .config import BROWSER_SERVICE_TOKEN, BROWSER_SERVICE_URL, SF_URL
+from .cyschoolhousesuite import get_driver, open_cyschoolhouse, session_login
+
+PROFILES = ('default', 'performance')
+TOKEN_HEADER = 'X-Browser-Service-Token'
+
+
+class LeaseUnavailable(Exception):
+    """Raised when no session frees up within the lease wait"""
+
+
+class LeaseLost(Exception):
+    """Raised when the service rejects the renewal of a lease, e.g. because
+    it expired and the session was taken back
+    """
+
+
+class WarmSession:
+    def __init__(self, profile):
+        self.profile = profile
+        self.driver = open_cyschoolhouse(get_driver(headless=True,
+                                                    profile=profile))
+        self.started = monotonic()
+        self.uses = 0
+        self.state = 'idle'
+        self.lease_id = None
+        self.renewed = None
+        self.checked = monotonic()
+
+    @property
+    def executor_url(self):
+        return self.driver.command_executor._url
+
+    def status(self):
+        now = monotonic()
+        return {
+            'profile': self.profile,
+            'state': self.state,
+            'session_id': self.driver.session_id,
+            'age': round(now - self.started),
+            'uses': self.uses,
+            'since_renewed': (round(now - self.renewed)
+                              if self.renewed is not None else None),
+        }
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+
+class BrowserService:
+    def __init__(self, max_sessions=4, warm=1, warm_profile='default',
+                 max_age=4*3600, max_uses=200, lease_timeout=900,
+                 check_interval=300):
+        """
+        max_sessions: most browsers to keep open at once
+        warm: idle sessions of `warm_profile` to keep ready ahead of leases
+        max_age: seconds after which a session is replaced
+        max_uses: leases after which a session is replaced
+        lease_timeout: seconds a lease may go without being renewed before
+                       the session is taken back
+        check_interval: seconds between login checks of an idle session
+        """
+        self.max_sessions = max_sessions
+        self.warm = warm
+        self.warm_profile = warm_profile
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.lease_timeout = lease_timeout
+        self.check_interval = check_interval
+        self.sessions = []
+        self._starting = 0
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def lease(self, profile='default', wait=60):
+        """ Lends an idle, logged-in session of `profile`, starting one if
+        there is room. Waits up to `wait` seconds for one to free up.
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"Invalid profile: {profile}. "
+                             f"Try one of {PROFILES}.")
+
+        deadline = monotonic() + wait
+        while True:
+            with self._changed:
+                session = self._take_idle(profile)
+                while session is None and not self._has_room():
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise LeaseUnavailable(
+                            f'No {profile} session free after {wait}s')
+                    self._changed.wait(remaining)
+                    session = self._take_idle(profile)
+                if session is None:
+                    self._starting += 1
+
+            if session is None:
+                session = self._start(profile)
+                if session is None:
+                    raise LeaseUnavailable(f'Could not start a {profile} '
+                                           'session')
+                session.state = 'leased'
+                session.renewed = monotonic()
+                with self._changed:
+                    self.sessions.append(session)
+            elif not self._is_alive(session):
+                self._recycle(session)
+                continue
+
+            session.lease_id = uuid.uuid4().hex
+            session.renewed = monotonic()
+            session.uses += 1
+            logging.info(f'Leased {profile} session '
+                         f'{session.driver.session_id}')
+            return {
+                'lease_id': session.lease_id,
+                'profile': profile,
+                'executor_url': session.executor_url,
+                'session_id': session.driver.session_id,
+                'lease_timeout': self.lease_timeout,
+            }
+
+    def renew(self, lease_id):
+        with self._changed:
+            session = self._find_lease(lease_id)
+            session.renewed = monotonic()
+
+    def release(self, lease_id, healthy=True):
+        """ Takes a session back. It is checked before its next lease, or
+        replaced at once if the borrower reports it broken.
+        """
+        with self._changed:
+            session = self._find_lease(lease_id)
+            session.lease_id = None
+            session.state = 'check' if healthy else 'broken'
+            self._changed.notify_all()
+        if not healthy:
+            self._recycle(session)
+
+    def status(self):
+        with self._changed:
+            return {
+                'max_sessions': self.max_sessions,
+                'starting': self._starting,
+                'sessions': [s.status() for s in self.sessions],
+            }
+
+    def maintain(self):
+        """ One round of upkeep: takes back expired leases, checks idle
+        sessions, replaces old or worn ones and keeps `warm` sessions ready.
+        """
+        now = monotonic()
+        to_check, to_recycle = [], []
+        with self._changed:
+            for s in self.sessions:
+                if s.state == 'leased' and \
+                        now - s.renewed > self.lease_timeout:
+                    logging.warning(f'Lease on {s.driver.session_id} expired')
+                    s.lease_id = None
+                    s.state = 'check'
+
+                if s.state not in ('idle', 'check'):
+                    continue
+                if now - s.started > self.max_age or s.uses >= self.max_uses:
+                    s.state = 'broken'
+                    to_recycle.append(s)
+                elif s.state == 'check' or \
+                        now - s.checked > self.check_interval:
+                    s.state = 'checking'
+                    to_check.append(s)
+
+        for s in to_recycle:
+            self._recycle(s)
+
+        for s in to_check:
+            ok = self._check(s)
+            with self._changed:
+                s.checked = monotonic()
+                s.state = 'idle' if ok else 'broken'
+                self._changed.notify_all()
+            if not ok:
+                logging.warning(f'Session {s.driver.session_id} failed its '
+                                'check, replacing it')
+                self._recycle(s)
+
+        self._top_up()
+
+    def start(self, interval=5):
+        """ Runs `maintain` every `interval` seconds on a background thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._changed:
+            sessions, self.sessions = self.sessions, []
+        for s in sessions:
+            s.quit()
+
+    def serve(self, host='127.0.0.1', port=None, token=BROWSER_SERVICE_TOKEN):
+        """ Serves the lease API until interrupted, to clients that send
+        `token`
+        """
+        if not token:
+            raise ValueError('Set BROWSER_SERVICE_TOKEN in .env to run the '
+                             'browser service')
+        port = port or urlparse(BROWSER_SERVICE_URL).port
+        server = ThreadingHTTPServer((host, port), _handler(self, token))
+        self.start()
+        logging.info(f'Browser service listening on {host}:{port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stop()
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.maintain()
+            except Exception:
+                logging.exception('Browser service upkeep failed')
+            self._stop.wait(interval)
+
+    def _take_idle(self, profile):
+        for s in self.sessions:
+            if s.profile == profile and s.state == 'idle':
+                s.state = 'leased'
+                s.renewed = monotonic()
+                return s
+        return None
+
+    def _has_room(self):
+        return len(self.sessions) + self._starting < self.max_sessions
+
+    def _find_lease(self, lease_id):
+        for s in self.sessions:
+            if lease_id is not None and s.lease_id == lease_id:
+                return s
+        raise KeyError(f'Unknown lease: {lease_id}')
+
+    def _start(self, profile):
+        try:
+            return WarmSession(profile)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            logging.exception(f'Could not start a {profile} session')
+            return None
+        finally:
+            with self._changed:
+                self._starting -= 1
+                self._changed.notify_all()
+
+    def _top_up(self):
+        while True:
+            with self._changed:
+                ready = sum(1 for s in self.sessions
+                            if s.profile == self.warm_profile
+                            and s.state in ('idle', 'check', 'checking'))
+                if ready >= self.warm or not self._has_room():
+                    return
+                self._starting += 1
+
+            session = self._start(self.warm_profile)
+            if session is None:
+                return
+            with self._changed:
+                self.sessions.append(session)
+                self._changed.notify_all()
+
+    def _recycle(self, session):
+        with self._changed:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            self._changed.notify_all()
+        session.quit()
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            session.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _check(session, timeout=15):
+        """ Returns True if the session is alive and logged in, signing it
+        back in with the API session if it has been logged out.
+        """
+        driver = session.driver
+        try:
+            driver.get(SF_URL)
+            WebDriverWait(driver, timeout).until(
+                EC.presence_of_element_located((By.ID, "tsidLabel"))
+            )
+            return True
+        except WebDriverException:
+            return session_login(driver)
+
+
+def _handler(service, token):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path == '/status':
+                self._reply(200, service.status())
+            else:
+                self._reply(404, {'error': f'Unknown path: {self.path}'})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            try:
+                if self.path == '/lease':
+                    self._reply(200, service.lease(**body))
+                elif self.path == '/renew':
+                    service.renew(body['lease_id'])
+                    self._reply(200, {})
+                elif self.path == '/release':
+                    service.release(**body)
+                    self._reply(200, {})
+                else:
+                    self._reply(404, {'error': f'Unknown path: {self.path}'})
+            except LeaseUnavailable as e:
+                self._reply(503, {'error': str(e)})
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {'error': str(e)})
+
+        def _authorized(self):
+            sent = self.headers.get(TOKEN_HEADER, '')
+            if hmac.compare_digest(sent.encode(), token.encode()):
+                return True
+            self._reply(401, {'error': 'Missing or wrong token'})
+            return False
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+class LeasedDriver(Remote):
+    """Driver attached to a session leased from the browser service.
+    `quit()` returns the session instead of closing the browser.
+
+    The lease is renewed from a background thread, so it holds while the job
+    waits on something else. If the service rejects a renewal, the next
+    command raises `LeaseLost`.
+    """
+
+    def __init__(self, lease, service_url=BROWSER_SERVICE_URL,
+                 lease_timeout=900):
+        self.lease = lease
+        self.service_url = service_url
+        self._renew_every = lease.get('lease_timeout', lease_timeout) / 3
+        self._lost = None
+        self._released = threading.Event()
+        super().__init__(command_executor=lease['executor_url'],
+                         desired_capabilities={}, keep_alive=True)
+        self._renewer = threading.Thread(target=self._renew_until_released,
+                                         name='lease-renewer', daemon=True)
+        self._renewer.start()
+
+    def start_session(self, capabilities, browser_profile=None):
+        # Attach to the leased session instead of creating one
+        self.session_id = self.lease['session_id']
+        self.capabilities = {'browserName': 'firefox'}
+        self.w3c = True
+
+    def execute(self, driver_command, params=None):
+        if self._lost:
+            raise self._lost
+        return super().execute(driver_command, params)
+
+    def quit(self, healthy=True):
+        """ Returns the session to the service. Pass `healthy=False` if the
+        browser is in a bad state, so it is replaced.
+        """
+        self._released.set()
+        if self._lost:
+            return
+        try:
+            _post(self.service_url, '/release',
+                  {'lease_id': self.lease['lease_id'], 'healthy': healthy})
+        except requests.RequestException as e:
+            logging.warning(f'Could not release browser lease: {e}')
+
+    def _renew_until_released(self):
+        while not self._released.wait(self._renew_every):
+            try:
+                _post(self.service_url, '/renew',
+                      {'lease_id': self.lease['lease_id']})
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code >= 500:
+                    logging.warning(f'Could not renew browser lease: {e}')
+                    continue
+                # The service no longer knows the lease, so the session may
+                # already be lent to another job
+                self._lost = LeaseLost(f'Browser lease '
+                                       f'{self.lease["lease_id"]} was '
+                                       f'rejected: {e}')
+                logging.error(str(self._lost))
+                return
+            except requests.RequestException as e:
+                logging.warning(f'Could not renew browser lease: {e}')
+
+
+def lease_driver(profile='default', service_url=BROWSER_SERVICE_URL,
+                 wait=60):
+    """ Returns a logged-in driver, leased from the browser service if it is
+    running, else a new local browser. Call `quit()` when done either way.
+    """
+    if not BROWSER_SERVICE_TOKEN:
+        logging.info('No BROWSER_SERVICE_TOKEN set, starting a browser')
+        return open_cyschoolhouse(get_driver(profile=profile))
+
+    try:
+        lease = _post(service_url, '/lease',
+                      {'profile': profile, 'wait': wait}, timeout=wait + 120)
+    except requests.RequestException as e:
+        logging.info(f'Browser service unavailable, starting a browser: {e}')
+        return open_cyschoolhouse(get_driver(profile=profile))
+
+    return LeasedDriver(lease, service_url)
+
+
+def service_status(service_url=BROWSER_SERVICE_URL):
+    response = requests.get(f'{service_url}/status', timeout=5,
+                            headers={TOKEN_HEADER: BROWSER_SERVICE_TOKEN})
+    response.raise_for_status()
+    return response.json()
+
+
+def _post(service_url, path, body, timeout=10):
+    response = requests.post(f'{service_url}{path}', json=body,
+                             headers={TOKEN_HEADER: BROWSER_SERVICE_TOKEN},
+                             timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--sessions', type=int, default=4,
+                        help='most browsers to keep open at once')
+    parser.add_argument('--warm', type=int, default=1,
+                        help='idle sessions to keep ready')
+    parser.add_argument('--profile', default='default', choices=PROFILES,
+                        help='driver profile of the warm sessions')
+    args = parser.parse_args()
+
+    BrowserService(max_sessions=args.sessions, warm=args.warm,
+                   warm_profile=args.profile).serve(port=args.port)
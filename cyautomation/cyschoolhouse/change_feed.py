@@ -0,0 +1,276 @@
+"""Change Feed
+Keeps the local replica current by subscribing to Salesforce Change Data
+Capture (or PushTopic) events instead of re-querying whole tables.
+
+    listener = ChangeFeedListener(['Student__c', 'Student_Section__c'])
+    listener.start()
+    cysh.get_object_df('Student__c', ['Id', 'Name'], local=True)
+
+Each channel's last replay id is checkpointed in the replica. On restart the
+listener replays from the checkpoint; if Salesforce no longer retains it, or
+reports a gap, the object is resynced in full.
+"""
+import logging
+import threading
+
+import requests
+
+from . import simple_cysh as cysh
+from .replica import get_replica, refresh
+
+API_VERSION = '47.0'
+
+
+class ReplayUnavailable(Exception):
+    """Raised when a subscription's replay id is outside the retention window"""
+
+
+class CometdEventSource:
+    """Long-polling CometD client for the Salesforce Streaming API"""
+
+    def __init__(self, api_version=API_VERSION):
+        self.api_version = api_version
+        self.session = requests.Session()
+        self.client_id = None
+        self.subscriptions = {}
+
+    @property
+    def url(self):
+        return f"https://{cysh.sf.sf_instance}/cometd/{self.api_version}"
+
+    def handshake(self):
+        response = self._post({
+            'channel': '/meta/handshake',
+            'version': '1.0',
+            'supportedConnectionTypes': ['long-polling'],
+        })[0]
+        if not response.get('successful'):
+            raise ConnectionError(f"CometD handshake failed: {response}")
+        self.client_id = response['clientId']
+
+    def subscribe(self, channel, replay_id=-1):
+        if self.client_id is None:
+            self.handshake()
+
+        response = self._post({
+            'channel': '/meta/subscribe',
+            'clientId': self.client_id,
+            'subscription': channel,
+            'ext': {'replay': {channel: replay_id}},
+        })[0]
+        if not response.get('successful'):
+            if 'replay' in str(response.get('error', '')).lower():
+                raise ReplayUnavailable(response.get('error'))
+            raise ConnectionError(f"Subscribe to {channel} failed: {response}")
+
+        self.subscriptions[channel] = replay_id
+
+    def poll(self):
+        """ Blocks until events arrive or the server times out the poll.
+        Returns a list of `{'channel': ..., 'data': ...}` messages.
+        """
+        messages = self._post({
+            'channel': '/meta/connect',
+            'clientId': self.client_id,
+            'connectionType': 'long-polling',
+        })
+
+        events = []
+        for message in messages:
+            if message['channel'] != '/meta/connect':
+                events.append(message)
+            elif not message.get('successful'):
+                advice = message.get('advice', {})
+                if advice.get('reconnect') == 'handshake':
+                    self._rehandshake()
+        return events
+
+    def _rehandshake(self):
+        self.client_id = None
+        self.handshake()
+        for channel, replay_id in self.subscriptions.items():
+            self.subscribe(channel, replay_id)
+
+    def _post(self, message):
+        response = self.session.post(
+            self.url,
+            json=[message],
+            headers={'Authorization': f'OAuth {cysh.sf.session_id}'},
+            timeout=130,
+        )
+        if response.status_code == 401:
+            cysh.sf = cysh.init_sf_session()
+            return self._post(message)
+        response.raise_for_status()
+        return response.json()
+
+
+class LocalEventSource:
+    """In-process stand-in for `CometdEventSource`, used for testing listeners
+    without a Salesforce org.
+
+    `retained` mimics the server's retention window: subscribing with a replay
+    id older than the oldest retained event raises `ReplayUnavailable`.
+    """
+
+    def __init__(self, retained=None):
+        self.retained = retained
+        self.events = []
+        self.subscriptions = {}
+        self._next_replay_id = 1
+
+    def publish(self, channel, payload):
+        event = {
+            'channel': channel,
+            'data': {'event': {'replayId': self._next_replay_id},
+                     'payload': payload},
+        }
+        self._next_replay_id += 1
+        self.events.append(event)
+        if self.retained is not None:
+            self.events = self.events[-self.retained:]
+        return event
+
+    def subscribe(self, channel, replay_id=-1):
+        oldest = min((e['data']['event']['replayId'] for e in self.events
+                      if e['channel'] == channel), default=None)
+        if replay_id >= 0 and oldest is not None and replay_id < oldest - 1:
+            raise ReplayUnavailable(f'{replay_id} is no longer retained')
+        self.subscriptions[channel] = (replay_id if replay_id >= 0
+                                       else self._next_replay_id - 1)
+
+    def poll(self):
+        events = []
+        for event in self.events:
+            channel = event['channel']
+            replay_id = event['data']['event']['replayId']
+            if channel in self.subscriptions and \
+                    replay_id > self.subscriptions[channel]:
+                events.append(event)
+                self.subscriptions[channel] = replay_id
+        return events
+
+
+class ChangeFeedListener:
+    def __init__(self, objects, replica=None, source=None, channels=None):
+        """
+        objects: Salesforce object names to replicate
+        replica: `Replica` to keep current (defaults to `REPLICA_PATH`)
+        source: event source (defaults to the Salesforce Streaming API)
+        channels: optional {object_name: channel} overrides, e.g. PushTopics
+        """
+        if isinstance(objects, str):
+            objects = [objects]
+
+        self.objects = objects
+        self.replica = replica or get_replica()
+        self.source = source or CometdEventSource()
+        self.channels = {obj: cdc_channel(obj) for obj in objects}
+        self.channels.update(channels or {})
+        self._objects_by_channel = {v: k for k, v in self.channels.items()}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe_all(self):
+        for object_name, channel in self.channels.items():
+            replay_id = self.replica.get_replay_id(channel)
+
+            if replay_id is not None:
+                try:
+                    self.source.subscribe(channel, replay_id)
+                    continue
+                except ReplayUnavailable:
+                    logging.warning(f'Replay id {replay_id} unavailable for '
+                                    f'{channel}, resyncing {object_name}')
+
+            # Subscribe before reloading so no change is missed in between
+            self.source.subscribe(channel, -1)
+            self.resync(object_name)
+
+    def resync(self, object_name):
+        refresh(object_name, replica=self.replica)
+
+    def run_once(self):
+        """ Polls the event source once and applies events to the replica.
+        Returns the number of events applied.
+        """
+        events = self.source.poll()
+        for event in events:
+            self.apply(event)
+        return len(events)
+
+    def apply(self, event):
+        channel = event['channel']
+        object_name = self._objects_by_channel.get(channel)
+        if object_name is None:
+            return
+
+        data = event['data']
+        if 'sobject' in data:
+            self._apply_pushtopic(object_name, data)
+        else:
+            self._apply_change_event(object_name, data['payload'])
+
+        self.replica.set_replay_id(channel, data['event']['replayId'])
+
+    def start(self):
+        """ Subscribes and applies events on a background thread.
+        """
+        self.subscribe_all()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:
+                logging.exception('Change feed poll failed, resubscribing')
+                self._stop.wait(30)
+                try:
+                    self.subscribe_all()
+                except Exception:
+                    logging.exception('Change feed resubscribe failed')
+
+    def _apply_change_event(self, object_name, payload):
+        header = payload['ChangeEventHeader']
+        change_type = header['changeType']
+        record_ids = header['recordIds']
+
+        if change_type.startswith('GAP') or change_type == 'OVERFLOW':
+            logging.warning(f'{change_type} event on {object_name}, resyncing')
+            self.resync(object_name)
+        elif change_type == 'DELETE':
+            self.replica.delete(object_name, record_ids)
+        else:
+            fields = {k: v for k, v in payload.items()
+                      if k != 'ChangeEventHeader' and not isinstance(v, dict)}
+            for field in header.get('nulledFields', []):
+                fields[field] = None
+            self.replica.upsert(object_name,
+                                [dict(fields, Id=i) for i in record_ids])
+
+    def _apply_pushtopic(self, object_name, data):
+        record = data['sobject']
+        if data['event']['type'] == 'deleted':
+            self.replica.delete(object_name, [record['Id']])
+        else:
+            self.replica.upsert(object_name, [record])
+
+
+def cdc_channel(object_name):
+    """ Returns the Change Data Capture channel for an object,
+    e.g. 'Student__c' -> '/data/Student__ChangeEvent'
+    """
+    if object_name.endswith('__c'):
+        return f"/data/{object_name[:-1]}ChangeEvent"
+    return f"/data/{object_name}ChangeEvent"
@@ -16,6 +16,11 @@ __all__ = [
     'LOG_PATH',
     'TEMP_PATH',
     'TEMPLATES_PATH',
+    'REPLICA_PATH',
+    'STATE_PATH',
+    'BROWSER_SERVICE_URL',
+    'BROWSER_SERVICE_TOKEN',
+    'MAP_SHAREPOINT_DRIVE',
 ]
 
 # configuration from .env
@@ -30,15 +35,24 @@ EXCEL_PROTECTION_PWD = os.environ['EXCEL_PROTECTION_PWD']
 OKTA_USER = os.getenv('OKTA_USER')
 OKTA_PASS = os.getenv('OKTA_PASS')
 
+BROWSER_SERVICE_URL = os.getenv('BROWSER_SERVICE_URL',
+                                'http://127.0.0.1:8765')
+BROWSER_SERVICE_TOKEN = os.getenv('BROWSER_SERVICE_TOKEN')
+
+MAP_SHAREPOINT_DRIVE = (os.getenv('MAP_SHAREPOINT_DRIVE', 'true').lower()
+                        not in ('false', '0', 'no'))
+
 # configuration
 INPUT_PATH = str(Path(__file__).parent / 'input_files')
 LOG_PATH = str(Path(__file__).parents[2] / 'logs')
 TEMP_PATH = str(Path(__file__).parents[2] / 'test')
+REPLICA_PATH = str(Path(__file__).parents[2] / 'replica.db')
+STATE_PATH = str(Path(__file__).parents[2] / 'state')
 TEMPLATES_PATH = Path(f"Z:/ChiPrivate/Chicago Data and Evaluation/{YEAR}/Templates/")
 SCH_REF_PATH = ('Z:/ChiPrivate/Chicago Data and Evaluation/'
                 f'{YEAR}/{YEAR} School Reference.xlsx')
 
-for path in [LOG_PATH, TEMP_PATH]:
+for path in [LOG_PATH, TEMP_PATH, STATE_PATH]:
     Path(path).mkdir(exist_ok=True)
 
 # logging
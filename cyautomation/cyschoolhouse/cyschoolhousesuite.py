@@ -6,25 +6,58 @@ and other common tasks we can antipicate needing to do for multiple products.
 """
 
 import getpass
-import io
 import logging
+import os
 import pickle
+import re
+import threading
 from pathlib import Path
-from time import sleep, time
+from tempfile import NamedTemporaryFile
+from time import monotonic, time
+from urllib.parse import quote, urlparse
+from urllib.request import getproxies
 
 import pandas as pd
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from seleniumrequests import Firefox
 
 from .config import LOG_PATH, SF_PASS, SF_URL, SF_USER, TEMP_PATH
+from .waits import wait_page_settled
 
 COOKIES_PATH = Path(__file__).parent / 'cookies.pkl'
 GECKO_PATH = str(Path(__file__).parents[2] / 'geckodriver/geckodriver.exe')
 
+# Firefox preferences of the 'performance' driver profile
+PERFORMANCE_PREFS = {
+    'permissions.default.image': 2,
+    'gfx.downloadable_fonts.enabled': False,
+    'toolkit.cosmeticAnimations.enabled': False,
+    'ui.prefersReducedMotion': 1,
+    'browser.cache.disk.enable': False,
+    'browser.cache.memory.capacity': 32768,
+    'browser.sessionhistory.max_entries': 5,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+    'media.autoplay.default': 5,
+    'datareporting.healthreport.uploadEnabled': False,
+    'toolkit.telemetry.enabled': False,
+}
+# Analytics and static asset hosts the 'performance' profile does not load
+BLOCKED_DOMAINS = [
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net',
+    'fonts.googleapis.com', 'fonts.gstatic.com', 'nr-data.net',
+    'js-agent.newrelic.com', 'demdex.net', 'omtrdc.net',
+]
+
+_page_loads = []
+_page_loads_lock = threading.Lock()
+
 
 def get_login_credentials(prompt_user_pass=False):
     """Extract login information from credentials.ini
@@ -49,20 +82,115 @@ def get_login_credentials(prompt_user_pass=False):
     return user, pwd
 
 
-def get_driver():
+class TimedFirefox(Firefox):
+    """Firefox driver that records how long each page load takes, by page
+    and driver profile, for `page_load_report`.
+    """
+    profile_name = 'default'
+
+    def get(self, url):
+        start = monotonic()
+        try:
+            return super().get(url)
+        finally:
+            record_page_load(self.profile_name, url, monotonic() - start)
+
+
+def get_driver(headless=False, profile='default'):
     """Get Firefox driver
 
     Returns the Firefox driver object and handles the path.
+
+    headless: run Firefox without a window, e.g. for `BrowserPool` workers
+    profile: 'default', or 'performance' for a headless browser that skips
+             images, web fonts, animations and `BLOCKED_DOMAINS`, and keeps
+             a small memory-only cache. 'performance' sets its own proxy
+             auto-config, which replaces Firefox's proxy settings; other
+             requests go through the system proxy, see `blocking_pac_url`
     """
-    profile = FirefoxProfile()
-    profile.set_preference('browser.download.folderList', 2)
-    profile.set_preference('browser.download.manager.showWhenStarting', False)
-    profile.set_preference('browser.download.dir', TEMP_PATH)
-    profile.set_preference('browser.helperApps.neverAsk.saveToDisk',
+    if profile not in ('default', 'performance'):
+        raise ValueError(f"Invalid profile: {profile}. "
+                         "Try 'default' or 'performance'.")
+
+    firefox_profile = FirefoxProfile()
+    firefox_profile.set_preference('browser.download.folderList', 2)
+    firefox_profile.set_preference('browser.download.manager.showWhenStarting', False)
+    firefox_profile.set_preference('browser.download.dir', TEMP_PATH)
+    firefox_profile.set_preference('browser.helperApps.neverAsk.saveToDisk',
                            ('application/csv,text/csv,application/vnd.ms-excel,'
                             'application/x-msexcel,application/excel,'
                             'application/x-excel,text/comma-separated-values'))
-    return Firefox(firefox_profile=profile, executable_path=GECKO_PATH)
+
+    if profile == 'performance':
+        headless = True
+        for key, value in PERFORMANCE_PREFS.items():
+            firefox_profile.set_preference(key, value)
+        firefox_profile.set_preference('network.proxy.type', 2)
+        firefox_profile.set_preference(
+            'network.proxy.autoconfig_url',
+            blocking_pac_url(BLOCKED_DOMAINS, system_proxy())
+        )
+
+    options = Options()
+    options.headless = headless
+    driver = TimedFirefox(firefox_profile=firefox_profile,
+                          executable_path=GECKO_PATH, options=options)
+    driver.profile_name = profile
+    return driver
+
+
+def blocking_pac_url(domains, proxy=None):
+    """Returns a proxy auto-config data URL that sends requests for
+    `domains` (and their subdomains) to a closed port, so they fail at once,
+    and sends everything else through `proxy` ('host:port'), or directly if
+    it is None.
+    """
+    conditions = ' || '.join(
+        f'host == "{d}" || dnsDomainIs(host, ".{d}")' for d in domains
+    ) or 'false'
+    upstream = f'PROXY {proxy}' if proxy else 'DIRECT'
+    pac = ('function FindProxyForURL(url, host) { '
+           f'if ({conditions}) return "PROXY 127.0.0.1:9"; '
+           f'return "{upstream}"; }}')
+    return 'data:application/x-ns-proxy-autoconfig,' + quote(pac)
+
+
+def system_proxy():
+    """Returns the 'host:port' of the system proxy (the Windows internet
+    settings, or the https_proxy/http_proxy environment variables), or None.
+    A proxy set by an auto-config script of its own is not found, and the
+    'performance' profile then connects directly.
+    """
+    proxies = getproxies()
+    proxy = proxies.get('https') or proxies.get('http')
+    if not proxy:
+        return None
+    if '://' not in proxy:
+        proxy = f'http://{proxy}'
+    return urlparse(proxy).netloc.rpartition('@')[2] or None
+
+
+def record_page_load(profile, url, seconds):
+    # Record Ids and query strings are dropped so loads group by page
+    page = re.sub(r'/[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?(?=/|$)', '/:id',
+                  urlparse(url).path) or '/'
+    with _page_loads_lock:
+        _page_loads.append((profile, page, seconds))
+
+
+def page_load_report():
+    """Returns the mean page-load seconds of each page under each driver
+    profile used so far, with the time the performance profile saved.
+    """
+    with _page_loads_lock:
+        df = pd.DataFrame(_page_loads, columns=['profile', 'page', 'seconds'])
+
+    report = df.pivot_table(index='page', columns='profile', values='seconds',
+                            aggfunc='mean')
+    if {'default', 'performance'} <= set(report.columns):
+        report['saved'] = report['default'] - report['performance']
+        report['saved_pct'] = 100 * report['saved'] / report['default']
+    return report
 
 
 def standard_login(driver, prompt_user_pass=False):
@@ -75,15 +203,23 @@ def standard_login(driver, prompt_user_pass=False):
     return driver
 
 
-def open_cyschoolhouse(driver=None, prompt_user_pass=False):
+def open_cyschoolhouse(driver=None, prompt_user_pass=False, fast_login=True):
     """Opens the cyschoolhouse instance
 
-    You will need to monitor your email inbox at this point to copy+paste an
-    authentication code.
+    With `fast_login`, the browser is first signed in with the API session
+    (see `session_login`), then with cookies saved by an earlier run. Only if
+    both fail are credentials typed into the login page, in which case you
+    may need to monitor your email inbox to copy+paste an authentication
+    code.
     """
     if driver is None:
         driver = get_driver()
 
+    if fast_login and not prompt_user_pass:
+        if session_login(driver) or cookie_login(driver):
+            save_cookies(driver)
+            return driver
+
     driver.get(SF_URL)
     WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.NAME, "username")))
 
@@ -95,17 +231,93 @@ def open_cyschoolhouse(driver=None, prompt_user_pass=False):
     WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.ID, "tsidLabel")))
     assert 'salesforce' in driver.current_url
 
+    save_cookies(driver)
+
     return driver
 
 
-def get_report(report_key):
-    driver = get_driver()
-    open_cyschoolhouse(driver)
-    url = f'{SF_URL}/{report_key}/?export=1&enc=UTF-8&xf=csv'
-    response = driver.request('GET', url)
-    df = pd.read_csv(io.StringIO(response.content.decode('utf-8')))
-    driver.quit()
-    return df
+def session_login(driver, timeout=15):
+    """Signs the browser in with the simple_salesforce API session through
+    frontdoor.jsp, skipping the login form and 2FA. Returns True on success.
+    """
+    try:
+        from . import simple_cysh as cysh
+        url = (f"https://{cysh.sf.sf_instance}/secur/frontdoor.jsp"
+               f"?sid={cysh.sf.session_id}")
+        driver.get(url)
+        _wait_logged_in(driver, timeout)
+        driver.get(SF_URL)
+        _wait_logged_in(driver, timeout)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        logging.info(f'Session login failed, trying cookies: {e}')
+        return False
+
+    logging.info('Signed in to cyschoolhouse with the API session')
+    return True
+
+
+def cookie_login(driver, cookies_path=COOKIES_PATH, timeout=15):
+    """Restores cookies saved by `save_cookies`. Returns True if they still
+    hold a valid session.
+    """
+    cookies_path = Path(cookies_path)
+    if not cookies_path.exists():
+        return False
+
+    try:
+        with open(cookies_path, 'rb') as f:
+            cookies = pickle.load(f)
+
+        # Cookies can only be set for the domain currently loaded
+        driver.get(SF_URL)
+        for cookie in cookies:
+            cookie.pop('expiry', None)
+            try:
+                driver.add_cookie(cookie)
+            except WebDriverException:
+                pass
+
+        driver.get(SF_URL)
+        _wait_logged_in(driver, timeout)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        logging.info(f'Cookie login failed, logging in with password: {e}')
+        return False
+
+    logging.info('Signed in to cyschoolhouse with saved cookies')
+    return True
+
+
+def save_cookies(driver, cookies_path=COOKIES_PATH):
+    """Saves the browser's cookies for `cookie_login`. They hold a live
+    session, so keep the file private.
+    """
+    cookies_path = Path(cookies_path)
+    try:
+        # Written aside and renamed, as several browsers may save at once
+        with NamedTemporaryFile('wb', dir=cookies_path.parent,
+                                delete=False) as f:
+            pickle.dump(driver.get_cookies(), f)
+        os.replace(f.name, cookies_path)
+    except (OSError, WebDriverException) as e:
+        logging.warning(f'Could not save cookies: {e}')
+
+
+def _wait_logged_in(driver, timeout):
+    WebDriverWait(driver, timeout).until(
+        EC.presence_of_element_located((By.ID, "tsidLabel"))
+    )
+
+
+def get_report(report_key, max_age=0):
+    """Returns a report's CSV export as a DataFrame, downloaded with the API
+    session rather than a browser. See `reports.get_report`.
+    """
+    from . import reports
+    return reports.get_report(report_key, max_age=max_age)
 
 
 def delete_folder(pth):
@@ -120,7 +332,7 @@ def delete_folder(pth):
 def fancy_box_wait(driver, waittime=10):
     WebDriverWait(driver, waittime).until(EC.presence_of_element_located((By.XPATH, ".//div[contains(@id, 'fancybox-wrap')]")))
     WebDriverWait(driver, (waittime+30)).until(EC.invisibility_of_element_located((By.XPATH, ".//div[contains(@id, 'fancybox-wrap')]")))
-    sleep(2)
+    wait_page_settled(driver, 'fancybox')
     return driver
 
 
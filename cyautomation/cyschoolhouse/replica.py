@@ -0,0 +1,443 @@
+"""Local Replica
+A SQLite copy of the cyschoolhouse objects we use. It is kept current by
+`change_feed`, so `get_object_df(..., local=True)` can be answered without a
+round trip to Salesforce, and it can be queried directly with SQL:
+
+    cysh.replica.refresh()
+    cysh.replica.sql('''
+        SELECT a.Name AS School, p.Name AS Program, COUNT(*) AS Enrollments
+        FROM Student_Section__c ss
+        JOIN Section__c s ON s.Id = ss.Section__c
+        JOIN Program__c p ON p.Id = s.Program__c
+        JOIN Account a ON a.Id = s.School__c
+        WHERE ss.Active__c = 1
+        GROUP BY a.Name, p.Name
+    ''')
+"""
+import json
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+from . import simple_cysh as cysh
+from .config import REPLICA_PATH
+
+# Objects mirrored by `refresh`, with the fields our scripts read
+REPLICATED_OBJECTS = {
+    'Account': ['Id', 'Name'],
+    'Assesment__c': [
+        'Id', 'Type__c', 'Date_Administered__c', 'X0_to_300_Scaled_Score__c',
+        'Student__c', 'Average_Daily_Attendance__c',
+        'SEL_Composite_T_Score__c'
+    ],
+    'Indicator_Area__c': ['Id', 'Indicator_Area_Type__c'],
+    'Indicator_Area_Student__c': ['Id', 'Student__c', 'Indicator_Area__c'],
+    'Intervention_Session__c': ['Id', 'Name', 'Comments__c', 'Section__c'],
+    'Intervention_Session_Result__c': [
+        'Id', 'Amount_of_Time__c', 'Intervention_Session_Date__c',
+        'Related_Student_s_Name__c', 'Intervention_Session__c',
+        'Student_Section__c', 'Primary_Skill__c', 'CreatedDate'
+    ],
+    'Picklist_Value__c': ['Id', 'Name'],
+    'Program__c': ['Id', 'Name'],
+    'Section__c': [
+        'Id', 'Name', 'School__c', 'Program__c',
+        'Intervention_Primary_Staff__c', 'Active__c', 'In_After_School__c',
+        'Target_Dosage_Section_Goal__c'
+    ],
+    'Setup__c': ['Id', 'School__c'],
+    'Staff__c': [
+        'Id', 'Individual__c', 'Name', 'First_Name_Staff__c',
+        'Staff_Last_Name__c', 'Role__c', 'Email__c', 'Organization__c',
+        'Site__c'
+    ],
+    'Student__c': [
+        'Id', 'Name', 'Local_Student_ID__c', 'External_Id__c',
+        'Student_Id__c', 'Student_First_Name__c', 'Student_Last_Name__c',
+        'School__c', 'School_Name__c', 'Grade__c', 'Date_of_Birth__c'
+    ],
+    'Student_Section__c': [
+        'Id', 'Name', 'Student_Program__c', 'Program__c', 'Section__c',
+        'Active__c', 'Intervention_Enrollment_Start_Date__c',
+        'Enrollment_End_Date__c', 'Section_Exit_Reason__c', 'Student__c',
+        'Student_Name__c', 'Dosage_to_Date__c', 'Amount_of_Time__c',
+        'School_Reference_Id__c', 'Student_Grade__c', 'School__c'
+    ],
+}
+
+# Lookup fields indexed alongside the Id primary key, wherever they appear
+LOOKUP_FIELDS = [
+    'Indicator_Area__c', 'Intervention_Primary_Staff__c',
+    'Intervention_Session__c', 'Organization__c', 'Program__c', 'School__c',
+    'Section__c', 'Student__c', 'Student_Program__c', 'Student_Section__c',
+    'Type__c',
+]
+
+# Tokens allowed in a SOQL WHERE clause that we will run against SQLite. Any
+# clause outside this subset (relationship fields, date literals, SOQL
+# functions) is sent to Salesforce instead.
+_SOQL_TOKEN = re.compile(
+    r"\s*('(?:[^'\\]|\\.)*'|<=|>=|!=|=|<|>|\(|\)|,|[A-Za-z_]\w*"
+    r"|-?\d+(?:\.\d+)?)"
+)
+_SOQL_KEYWORDS = {'AND', 'OR', 'NOT', 'IN', 'LIKE', 'NULL', 'TRUE', 'FALSE'}
+_SOQL_COMPARISONS = {'=', '!=', '<', '>', '<=', '>=', 'LIKE', 'IN', 'NOT IN'}
+
+
+class Replica:
+    def __init__(self, path=REPLICA_PATH):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self.con:
+            self.con.execute(
+                "CREATE TABLE IF NOT EXISTS _replay "
+                "(channel TEXT PRIMARY KEY, replay_id INTEGER)"
+            )
+            self.con.execute(
+                "CREATE TABLE IF NOT EXISTS _synced "
+                "(object_name TEXT PRIMARY KEY, synced_at TEXT, fields TEXT)"
+            )
+            # Replicas made before fields were recorded
+            synced_cols = [r[1] for r in self.con.execute(
+                "PRAGMA table_info(_synced)").fetchall()]
+            if 'fields' not in synced_cols:
+                self.con.execute("ALTER TABLE _synced ADD COLUMN fields TEXT")
+
+    def has_object(self, object_name):
+        with self._lock:
+            row = self.con.execute(
+                "SELECT 1 FROM _synced WHERE object_name = ?", (object_name,)
+            ).fetchone()
+        return row is not None
+
+    def loaded_fields(self, object_name):
+        """ Returns the fields of the last full load of `object_name`. Other
+        columns hold only what change events have filled in since, so they
+        are not complete.
+        """
+        with self._lock:
+            row = self.con.execute(
+                "SELECT fields FROM _synced WHERE object_name = ?",
+                (object_name,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    def columns(self, object_name):
+        with self._lock:
+            rows = self.con.execute(
+                f'PRAGMA table_info("{object_name}")'
+            ).fetchall()
+        return [r[1] for r in rows]
+
+    def load(self, object_name, df):
+        """ Replaces the replica of `object_name` with the records in `df`.
+        Used for the initial sync and whenever the change feed must resync.
+        """
+        records = df.to_dict('records')
+        with self._lock, self.con:
+            self._ensure_table(object_name, df.columns)
+            self.con.execute(f'DELETE FROM "{object_name}"')
+            self._upsert(object_name, records)
+            self._ensure_indexes(object_name)
+            self.con.execute(
+                "INSERT OR REPLACE INTO _synced VALUES (?, ?, ?)",
+                (object_name, datetime.now().isoformat(),
+                 json.dumps(list(df.columns)))
+            )
+        logging.info(f'Replicated {len(records)} {object_name} records')
+
+    def upsert(self, object_name, records):
+        """ Inserts or updates records by Id. Fields missing from a record are
+        left untouched, which matches the partial payloads of update events.
+        """
+        if not records:
+            return
+        fields = {k for r in records for k in r}
+        with self._lock, self.con:
+            self._ensure_table(object_name, fields)
+            self._upsert(object_name, records)
+
+    def delete(self, object_name, ids):
+        if not ids:
+            return
+        with self._lock, self.con:
+            self._ensure_table(object_name, ['Id'])
+            self.con.executemany(
+                f'DELETE FROM "{object_name}" WHERE "Id" = ?',
+                [(i,) for i in ids]
+            )
+
+    def get_replay_id(self, channel):
+        with self._lock:
+            row = self.con.execute(
+                "SELECT replay_id FROM _replay WHERE channel = ?", (channel,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_replay_id(self, channel, replay_id):
+        with self._lock, self.con:
+            self.con.execute(
+                "INSERT OR REPLACE INTO _replay VALUES (?, ?)",
+                (channel, replay_id)
+            )
+
+    def read(self, object_name, field_list=None, where=None):
+        """ Returns the replicated records as a DataFrame, or None when the
+        request cannot be answered locally. Only fields of the last full load
+        are served.
+        """
+        if not self.has_object(object_name):
+            return None
+
+        columns = self.loaded_fields(object_name)
+        field_list = field_list or columns
+        if not field_list or not set(field_list) <= set(columns):
+            return None
+
+        query = (f"SELECT {', '.join(_quote(f) for f in field_list)} "
+                 f'FROM "{object_name}"')
+        if where:
+            tokens = _soql_tokens(where) or []
+            if not {t for t in tokens if _is_field(t)} <= set(columns):
+                return None
+            where = soql_where_to_sql(where)
+            if where is None:
+                return None
+            query += f" WHERE {where}"
+
+        try:
+            with self._lock:
+                df = pd.read_sql_query(query, self.con)
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            logging.info(f'Replica cannot answer query, using API: {e}')
+            return None
+
+        return df[field_list]
+
+    def sql(self, query, params=None):
+        """ Runs a read query against the replica and returns a DataFrame.
+        Tables are named after their Salesforce objects.
+        """
+        with self._lock:
+            return pd.read_sql_query(query, self.con, params=params)
+
+    def _ensure_table(self, object_name, fields):
+        self.con.execute(
+            f'CREATE TABLE IF NOT EXISTS "{object_name}" '
+            '("Id" TEXT PRIMARY KEY)'
+        )
+        existing = set(self.columns(object_name))
+        for field in fields:
+            if field not in existing:
+                self.con.execute(
+                    f'ALTER TABLE "{object_name}" ADD COLUMN {_quote(field)}'
+                )
+
+    def _ensure_indexes(self, object_name):
+        for field in set(LOOKUP_FIELDS) & set(self.columns(object_name)):
+            self.con.execute(
+                f'CREATE INDEX IF NOT EXISTS "ix_{object_name}_{field}" '
+                f'ON "{object_name}" ({_quote(field)})'
+            )
+
+    def _upsert(self, object_name, records):
+        by_fields = {}
+        for record in records:
+            record = {k: _to_sql_value(v) for k, v in record.items()
+                      if k != 'attributes'}
+            by_fields.setdefault(tuple(record), []).append(record)
+
+        for fields, group in by_fields.items():
+            cols = ', '.join(_quote(f) for f in fields)
+            params = ', '.join('?' for _ in fields)
+            updates = ', '.join(f'{_quote(f)} = excluded.{_quote(f)}'
+                                for f in fields if f != 'Id')
+            query = (f'INSERT INTO "{object_name}" ({cols}) VALUES ({params}) '
+                     'ON CONFLICT("Id") DO '
+                     + (f'UPDATE SET {updates}' if updates else 'NOTHING'))
+            self.con.executemany(query,
+                                 [tuple(r[f] for f in fields) for r in group])
+
+
+def refresh(objects=None, replica=None):
+    """ Reloads objects from Salesforce into the replica.
+
+    objects: list of object names (defaults to `REPLICATED_OBJECTS`)
+    """
+    replica = replica or get_replica()
+    objects = objects or list(REPLICATED_OBJECTS)
+    if isinstance(objects, str):
+        objects = [objects]
+
+    for object_name in objects:
+        df = cysh.get_object_df(object_name,
+                                REPLICATED_OBJECTS.get(object_name))
+        replica.load(object_name, df)
+
+    return replica
+
+
+def sql(query, params=None):
+    """ Runs a read query against the process-wide replica.
+    """
+    return get_replica().sql(query, params)
+
+
+def soql_where_to_sql(where):
+    """ Translates a simple SOQL WHERE clause to SQLite. Returns None if the
+    clause uses anything beyond plain comparisons on this object's fields.
+
+    SOQL semantics are kept where SQLite differs: `= null` and `!= null`
+    become `IS [NOT] NULL`, string comparisons ignore case, and `!=` and
+    `NOT IN` also match null fields.
+    """
+    tokens = _soql_tokens(where)
+    if tokens is None:
+        return None
+
+    out = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        upper = token.upper()
+        if upper in ('AND', 'OR', 'NOT', '(', ')'):
+            out.append(upper)
+            i += 1
+            continue
+        if not _is_field(token):
+            return None
+
+        condition, i = _soql_condition(tokens, i)
+        if condition is None:
+            return None
+        out.append(condition)
+
+    return ' '.join(out)
+
+
+def _soql_tokens(where):
+    tokens = []
+    pos = 0
+    while pos < len(where):
+        if where[pos:].isspace():
+            break
+        match = _SOQL_TOKEN.match(where, pos)
+        if not match:
+            return None
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def _soql_condition(tokens, i):
+    """ Translates `field op value` starting at `tokens[i]`. Returns the SQL
+    and the index after the condition, or (None, i) if not supported.
+    """
+    column = _quote(tokens[i])
+    i += 1
+
+    op = tokens[i].upper() if i < len(tokens) else None
+    if op == 'NOT' and i + 1 < len(tokens) and tokens[i + 1].upper() == 'IN':
+        op = 'NOT IN'
+        i += 1
+    if op not in _SOQL_COMPARISONS:
+        return None, i
+    i += 1
+
+    if op in ('IN', 'NOT IN'):
+        if i >= len(tokens) or tokens[i] != '(':
+            return None, i
+        values = []
+        i += 1
+        while i < len(tokens) and tokens[i] != ')':
+            if tokens[i] != ',':
+                values.append(tokens[i])
+            i += 1
+        i += 1
+        if not values:
+            return None, i
+    elif i < len(tokens):
+        values = [tokens[i]]
+        i += 1
+    else:
+        return None, i
+
+    literals = [_soql_literal(v) for v in values]
+    if None in literals:
+        return None, i
+
+    if any(v.upper() == 'NULL' for v in values):
+        if op == '=' and len(values) == 1:
+            return f'{column} IS NULL', i
+        if op == '!=' and len(values) == 1:
+            return f'{column} IS NOT NULL', i
+        return None, i
+
+    # SQLite's LIKE already ignores case for ASCII
+    field = column
+    if op != 'LIKE' and any(v.startswith("'") for v in values):
+        field = f'{column} COLLATE NOCASE'
+
+    if op in ('IN', 'NOT IN'):
+        condition = f"{field} {op} ({', '.join(literals)})"
+    else:
+        condition = f'{field} {op} {literals[0]}'
+
+    # SOQL's != and NOT IN match records where the field is null
+    if op in ('!=', 'NOT IN'):
+        condition = f'({column} IS NULL OR {condition})'
+
+    return condition, i
+
+
+def _is_field(token):
+    return (re.fullmatch(r'[A-Za-z_]\w*', token) is not None
+            and token.upper() not in _SOQL_KEYWORDS)
+
+
+def _soql_literal(token):
+    """ Returns a SOQL literal as SQLite, or None if it is not one"""
+    upper = token.upper()
+    if upper == 'NULL':
+        return 'NULL'
+    if upper in ('TRUE', 'FALSE'):
+        return '1' if upper == 'TRUE' else '0'
+    if token.startswith("'"):
+        value = re.sub(r'\\(.)', r'\1', token[1:-1])
+        return "'" + value.replace("'", "''") + "'"
+    if re.fullmatch(r'-?\d+(?:\.\d+)?', token):
+        return token
+    return None
+
+
+def _quote(field):
+    return '"' + field.replace('"', '""') + '"'
+
+
+def _to_sql_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, float) and value != value:
+        return None
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+
+_default = None
+
+
+def get_replica():
+    """ Returns the process-wide replica at `REPLICA_PATH`.
+    """
+    global _default
+    if _default is None:
+        _default = Replica()
+    return _default
@@ -0,0 +1,95 @@
+"""Reports
+Exports Salesforce reports to DataFrames over plain HTTP, signed in with the
+simple_salesforce API session, so no browser is needed. The CSV export is
+streamed straight into pandas, several reports can be fetched at once, and
+results are cached for `max_age` seconds.
+
+    df = get_report('00O1a000002Xyz')
+    dfs = get_reports(['00O1a000002Xyz', '00O1a000003Abc'])
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import pandas as pd
+import requests
+
+from . import simple_cysh as cysh
+
+DEFAULT_MAX_AGE = 300
+
+_cache = {}
+_cache_lock = threading.Lock()
+_local = threading.local()
+
+
+class ReportSessionExpired(Exception):
+    """Raised when Salesforce answers an export with its login page"""
+
+
+def get_report(report_key, max_age=DEFAULT_MAX_AGE):
+    """ Returns a report's CSV export as a DataFrame.
+
+    max_age: seconds a cached copy of the report stays fresh; 0 always
+             downloads it again
+    """
+    if max_age:
+        with _cache_lock:
+            cached = _cache.get(report_key)
+        if cached and monotonic() - cached[0] <= max_age:
+            logging.info(f'Using cached report {report_key}')
+            return cached[1].copy()
+
+    df = _export(report_key)
+    with _cache_lock:
+        _cache[report_key] = (monotonic(), df)
+
+    return df.copy()
+
+
+def get_reports(report_keys, max_age=DEFAULT_MAX_AGE, max_workers=4):
+    """ Returns {report key: DataFrame} for several reports, downloading
+    them concurrently.
+    """
+    report_keys = list(dict.fromkeys(report_keys))
+    with ThreadPoolExecutor(max_workers) as executor:
+        dfs = executor.map(lambda key: get_report(key, max_age), report_keys)
+        return dict(zip(report_keys, dfs))
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _export(report_key, retry=True):
+    url = (f"https://{cysh.sf.sf_instance}/{report_key}"
+           "?export=1&enc=UTF-8&xf=csv")
+    start = monotonic()
+
+    with _session().get(url, cookies={'sid': cysh.sf.session_id},
+                        stream=True, timeout=300) as response:
+        response.raise_for_status()
+        try:
+            if 'text/html' in response.headers.get('Content-Type', ''):
+                raise ReportSessionExpired(f'Report {report_key} returned '
+                                           'the login page')
+            response.raw.decode_content = True
+            df = pd.read_csv(response.raw, encoding='utf-8')
+        except ReportSessionExpired:
+            if not retry:
+                raise
+            cysh.sf = cysh.init_sf_session()
+            return _export(report_key, retry=False)
+
+    logging.info(f'Exported report {report_key}: {len(df)} rows in '
+                 f'{monotonic() - start:.1f}s')
+    return df
+
+
+def _session():
+    # requests sessions are not thread-safe, so each thread keeps its own
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
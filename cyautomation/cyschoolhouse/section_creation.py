@@ -3,8 +3,8 @@ Automated creation of sections in cyschoolhouse.
 """
 import logging
 import os
+import re
 from pathlib import Path
-from time import sleep
 
 import pandas as pd
 from selenium.common.exceptions import TimeoutException
@@ -12,11 +12,14 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
+from .browser_pool import BrowserPool
+from .browser_service import lease_driver
 from .config import SF_URL
 from .cyschoolhousesuite import get_driver, open_cyschoolhouse
 from .simple_cysh import (execute_query, get_object_df, get_section_df,
                           get_staff_df, in_str)
 from .utils import validate_date
+from .waits import wait_for, wait_page_settled
 
 
 class Section:
@@ -35,9 +38,20 @@ class Section:
 
         self.nickname = nickname
 
-    def create(self, driver=None):
-        """Creates a single section"""
-        exists_as_id = self.check_exists()
+    @property
+    def key(self):
+        return (self.program, self.corps_member, self.school)
+
+    def create(self, driver=None, index=None):
+        """Creates a single section
+
+        index: optional `SectionIndex` to check for an existing section
+               instead of querying, and to record the new section in
+        """
+        if index is not None:
+            exists_as_id = index.get(*self.key)
+        else:
+            exists_as_id = self.check_exists()
         if exists_as_id:
             logging.info(
                 f"{self.program} section already exists for "
@@ -57,13 +71,19 @@ class Section:
         self._set_start_date(driver)
         self._set_end_date(driver)
         self._set_in_after_sch(driver)
-        sleep(1)
+        wait_page_settled(driver, 'section.before_save')
         self._save_section(driver)
         logging.info(f"Created {self.program} section for {self.corps_member}")
+        section_id = _record_id_from_url(driver.current_url) or True
+
+        if index is not None:
+            index.add(*self.key, section_id)
 
         if self.nickname:
             self._set_nickname(driver)
 
+        return section_id
+
     def check_exists(self):
         inputs = [self.program, self.corps_member, self.school]
         clean_inputs = [s.replace("'", "\\'") for s in inputs]
@@ -89,7 +109,7 @@ class Section:
         )
         dropdown = Select(driver.find_element_by_id("j_id0:j_id1:school-selector"))
         dropdown.select_by_visible_text(self.school)
-        sleep(2)
+        wait_page_settled(driver, 'section.school')
 
     def _set_program(self, driver):
         """Selects the section type.
@@ -104,7 +124,12 @@ class Section:
         except TimeoutException:
             logging.warning("May have failed to choose subject")
 
-        sleep(2.5)
+        wait_page_settled(driver, 'section.program')
+        wait_for(
+            driver,
+            EC.element_to_be_clickable((By.ID, "j_id0:j_id1:staffID")),
+            'section.staff_list'
+        )
 
     def _set_corps_member(self, driver):
         """Selects the staff name from the drop down
@@ -135,10 +160,68 @@ class Section:
 
     def _set_nickname(self, driver):
         driver.find_element_by_css_selector('#topButtonRow > input:nth-child(3)').click()
-        sleep(2)
-        driver.find_element_by_id("00N1a000006Syte").send_keys(self.nickname)
+        nickname = wait_for(
+            driver, EC.element_to_be_clickable((By.ID, "00N1a000006Syte")),
+            'section.nickname_form'
+        )
+        nickname.send_keys(self.nickname)
         driver.find_element_by_xpath("//input[@value=' Save ']").click()
-        sleep(2)
+        wait_for(driver, EC.staleness_of(nickname), 'section.nickname_save')
+        wait_page_settled(driver, 'section.nickname_save')
+
+
+class SectionIndex:
+    """Existing sections keyed by (program, staff name, school), loaded with
+    one query so that `Section.create` can skip existing sections without
+    querying for each one.
+    """
+    def __init__(self, programs=None, schools=None):
+        if isinstance(programs, str):
+            programs = [programs]
+        if isinstance(schools, str):
+            schools = [schools]
+
+        query = ("SELECT Id, Program__r.Name, "
+                 "Intervention_Primary_Staff__r.Name, School__r.Name "
+                 "FROM Section__c")
+        conditions = []
+        if programs is not None:
+            conditions.append(f"Program__r.Name IN {in_str(programs)}")
+        if schools is not None:
+            conditions.append(f"School__r.Name IN {in_str(schools)}")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        self._ids = {}
+        for record in execute_query(query)['records']:
+            key = tuple(
+                (record[relationship] or {}).get('Name')
+                for relationship in ['Program__r',
+                                     'Intervention_Primary_Staff__r',
+                                     'School__r']
+            )
+            self._ids.setdefault(self._normalize(*key), record['Id'])
+
+        logging.info(f'Indexed {len(self._ids)} existing sections')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        return self._normalize(*key) in self._ids
+
+    def get(self, program, corps_member, school):
+        """Returns the Id of a matching section, or False"""
+        return self._ids.get(self._normalize(program, corps_member, school),
+                             False)
+
+    def add(self, program, corps_member, school, section_id=True):
+        self._ids[self._normalize(program, corps_member, school)] = section_id
+
+    @staticmethod
+    def _normalize(*key):
+        # SOQL string comparisons are case-insensitive
+        return tuple(x.casefold() if isinstance(x, str) else x for x in key)
 
 
 class Sections:
@@ -165,7 +248,12 @@ class Sections:
 
         self.schools = schools
 
-    def create_all(self, start_date, end_date, in_sch_ext_lrn, driver=None):
+    def create_all(self, start_date, end_date, in_sch_ext_lrn, driver=None,
+                   n_workers=1, profile='default'):
+        """
+        n_workers: headless browsers to use at once
+        profile: driver profile of new browsers, see `get_driver`
+        """
         assert in_sch_ext_lrn in {'In School', 'Extended Learning', 'Curriculum'}
         validate_date(start_date)
         validate_date(end_date)
@@ -215,34 +303,20 @@ class Sections:
 
         logging.info(f'Creating {len(staff_df)} {self.program} sections')
 
-        if driver is None:
-            driver = get_driver()
-            open_cyschoolhouse(driver=driver)
-
-        for _, row in staff_df.iterrows():
-            try:
-                section = Section(
-                    school=row['School'],
-                    corps_member=row['Staff__c_Name'],
-                    program=self.program,
-                    in_after_sch=in_sch_ext_lrn,
-                    start_date=start_date,
-                    end_date=end_date,
-                )
-                section.create(driver)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except Exception as e:
-                logging.error(f"Section creation failed for {row['ACM']}, {row['SectionName']}: {e}")
-                driver.get(SF_URL)
-                try:
-                    WebDriverWait(driver, 3).until(EC.alert_is_present())
-                    driver.switch_to.alert.accept()
-                    sleep(2)
-                except TimeoutException:
-                    pass
-
-        driver.quit()
+        sections = [
+            Section(
+                school=row['School'],
+                corps_member=row['Staff__c_Name'],
+                program=self.program,
+                in_after_sch=in_sch_ext_lrn,
+                start_date=start_date,
+                end_date=end_date,
+            )
+            for _, row in staff_df.iterrows()
+        ]
+
+        create_sections(sections, driver=driver, n_workers=n_workers,
+                        profile=profile)
 
     def query_all(self):
         return get_section_df(programs=self.program)
@@ -251,9 +325,12 @@ class Sections:
         raise NotImplementedError
 
 
-def create_all_sections(data=pd.DataFrame(), driver=None):
+def create_all_sections(data=pd.DataFrame(), driver=None, n_workers=1,
+                        profile='default'):
     """Loads sections to create from the
     spreadsheet at 'input_files/section-creator-input.xlsx'.
+
+    n_workers, profile: see `create_sections`
     """
     if data.empty:
         data = pd.read_excel(os.path.join(os.path.dirname(__file__),
@@ -265,35 +342,92 @@ def create_all_sections(data=pd.DataFrame(), driver=None):
     data['End_Date'] = pd.to_datetime(data['End_Date']).dt.strftime('%m/%d/%Y')
     data = data.fillna('').replace('NaT', '')
 
-    if driver is None:
-        driver = get_driver()
-        open_cyschoolhouse(driver=driver)
+    index = SectionIndex(programs=data['SectionName'].unique(),
+                         schools=data['School'].unique())
 
+    sections = []
     for _, row in data.iterrows():
         try:
-            section = Section(
+            sections.append(Section(
                 school=row['School'],
                 corps_member=row['ACM'],
                 program=row['SectionName'],
                 in_after_sch=row['In_School_or_Extended_Learning'],
                 start_date=row['Start_Date'],
                 end_date=row['End_Date'],
-            )
-            section.create(driver)
+            ))
+        except ValueError as e:
+            logging.error(f"Section creation failed for {row['ACM']}, "
+                          f"{row['SectionName']}: {e}")
+
+    create_sections(sections, driver=driver, index=index,
+                    n_workers=n_workers, profile=profile)
+
+
+def create_sections(sections, driver=None, index=None, n_workers=1,
+                    profile='default'):
+    """Creates sections that do not already exist.
+
+    index: optional `SectionIndex`, loaded for the given sections by default
+    n_workers: headless browsers to create sections with at once, when no
+               `driver` is given
+    profile: driver profile of new browsers, see `get_driver`
+    """
+    if not sections:
+        return
+
+    if index is None:
+        index = SectionIndex(programs={x.program for x in sections},
+                             schools={x.school for x in sections})
+
+    if driver is None and n_workers > 1:
+        # No retries: a section can be saved before the step that failed,
+        # and creating it again would make a duplicate
+        pool = BrowserPool(n_workers, max_retries=0, on_error=_recover,
+                           profile=profile)
+        report = pool.map(
+            lambda driver, section: section.create(driver, index=index),
+            sections
+        )
+        for _, row in report.loc[~report['success']].iterrows():
+            logging.error(f"Section creation failed for "
+                          f"{row['item'].corps_member}, {row['item'].program}: "
+                          f"{row['error']}")
+        return
+
+    if driver is None:
+        driver = lease_driver(profile)
+
+    for section in sections:
+        try:
+            section.create(driver, index=index)
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as e:
-            logging.error(f"Section creation failed for {row['ACM']}, {row['SectionName']}: {e}")
-            driver.get(SF_URL)
-            try:
-                WebDriverWait(driver, 3).until(EC.alert_is_present())
-                driver.switch_to.alert.accept()
-                sleep(2)
-            except TimeoutException:
-                pass
+            logging.error(f"Section creation failed for "
+                          f"{section.corps_member}, {section.program}: {e}")
+            _recover(driver)
 
     driver.quit()
 
 
+def _recover(driver):
+    """Returns to the home page, dismissing any alert left by a failure"""
+    driver.get(SF_URL)
+    try:
+        WebDriverWait(driver, 3).until(EC.alert_is_present())
+        driver.switch_to.alert.accept()
+        wait_page_settled(driver, 'section.recover')
+    except TimeoutException:
+        pass
+
+
+def _record_id_from_url(url):
+    """Returns the record Id a Salesforce detail page URL points to, if any"""
+    match = re.search(r'/([a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?)(?:[/?#]|$)',
+                      url or '')
+    return match.group(1) if match else None
+
+
 if __name__ == '__main__':
     create_all_sections()
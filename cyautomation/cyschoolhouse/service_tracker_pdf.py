@@ -0,0 +1,166 @@
+"""Service Tracker PDF
+Draws Weekly Service Tracker pages straight to PDF with reportlab, following
+the layout of the 'Service Tracker Template.xlsx' sheets. Unlike exporting
+from Excel, this runs anywhere and can be spread over a process pool.
+"""
+from datetime import date, timedelta
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import (Paragraph, SimpleDocTemplate, Spacer, Table,
+                                TableStyle)
+
+# Rows available in each section of the template
+COURSE_PERFORMANCE_ROWS = 12
+SEL_ROWS = 6
+CICO_ROWS = 3
+
+DAYS = ['M', 'T', 'W', 'Th', 'F']
+COMMENT_CODES = 'T1   T2   ELT'
+
+MISSED_TOT_CODES = (
+    'Missed ToT Codes: A-CM Absent  B-CM Not Prepared  C-Stdnt Absent  '
+    'D-Stdnt Refusal  E-Out of Sch Susp  F-In Sch Susp  G-Testing  '
+    'H-Class Structure  I-Teacher Refusal'
+)
+
+_styles = getSampleStyleSheet()
+_title = _styles['Heading4'].clone('title', spaceBefore=4, spaceAfter=2)
+_cell = _styles['BodyText'].clone('cell', fontSize=8, leading=9)
+_note = _styles['BodyText'].clone('note', fontSize=7, leading=8)
+
+_grid = TableStyle([
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('FONTSIZE', (0, 0), (-1, -1), 8),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+])
+
+
+def week_start(today=None):
+    """ Monday of the week being tracked, as computed by the template's
+    `=TODAY()-WEEKDAY(TODAY())+2` (so Sundays look ahead to Monday).
+    """
+    today = today or date.today()
+    return today - timedelta(days=today.isoweekday() % 7) + timedelta(days=1)
+
+
+def render_acm_pdf(acm_name, course_performance, sel, attendance,
+                   week=None):
+    """ Returns one ACM's Service Tracker as PDF bytes.
+
+    course_performance: list of (student name, dosage text) pairs
+    sel: list of student names
+    attendance: list of student names
+    week: date of the week's Monday, defaults to `week_start()`
+    """
+    week = week or week_start()
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=letter, title=f'{acm_name} Service Tracker',
+        leftMargin=0.4*inch, rightMargin=0.4*inch,
+        topMargin=0.4*inch, bottomMargin=0.4*inch,
+    )
+    doc.build(
+        _header(acm_name, week)
+        + _course_performance(course_performance)
+        + _sel(sel)
+        + _attendance_cico(attendance)
+    )
+
+    return buffer.getvalue()
+
+
+def _para(text, style=_cell):
+    return Paragraph(escape(str(text)).replace('\r\n', '<br/>')
+                                      .replace('\n', '<br/>'), style)
+
+
+def _pad(rows, n, width):
+    rows = [list(r) for r in rows[:n]]
+    return rows + [[''] * width for _ in range(n - len(rows))]
+
+
+def _header(acm_name, week):
+    table = Table(
+        [[_para(acm_name, _title), 'Week:', f'{week:%m/%d/%Y}']],
+        colWidths=[4.2*inch, 0.8*inch, 2.6*inch],
+    )
+    return [
+        table,
+        _para('If found, please return this page to any City Year '
+              'AmeriCorps Member.', _note),
+        Spacer(0, 0.1*inch),
+    ]
+
+
+def _course_performance(students):
+    rows = [[_para(name), _para(dosage)] + [COMMENT_CODES] * len(DAYS)
+            for name, dosage in students[:COURSE_PERFORMANCE_ROWS]]
+    rows = _pad(rows, COURSE_PERFORMANCE_ROWS, 2 + len(DAYS))
+
+    table = Table(
+        [['Student', 'Total ToT'] + DAYS] + rows,
+        colWidths=[1.9*inch, 0.7*inch] + [1.0*inch] * len(DAYS),
+        rowHeights=[None] + [0.3*inch] * COURSE_PERFORMANCE_ROWS,
+    )
+    table.setStyle(_grid)
+
+    return [
+        _para('Course Performance - Time on Task, Skills Covered, Comment '
+              'Code (T1/T2/ELT), or Reason for Missed Intervention', _title),
+        table,
+        _para(MISSED_TOT_CODES, _note),
+        Spacer(0, 0.1*inch),
+    ]
+
+
+def _sel(students):
+    rows = _pad([[_para(name)] for name in students[:SEL_ROWS]], SEL_ROWS, 1)
+    rows = [r + [''] * 5 for r in rows]
+
+    table = Table(
+        [['Student', 'Session 1', '', 'Session 2', '',
+          'Skills / Goals / Notes'],
+         ['', 'Date', 'ToT', 'Date', 'ToT', '']] + rows,
+        colWidths=[1.9*inch, 0.7*inch, 0.6*inch, 0.7*inch, 0.6*inch,
+                   3.1*inch],
+        rowHeights=[None, None] + [0.26*inch] * SEL_ROWS,
+    )
+    table.setStyle(_grid)
+    table.setStyle(TableStyle([
+        ('SPAN', (1, 0), (2, 0)), ('SPAN', (3, 0), (4, 0)),
+        ('SPAN', (0, 0), (0, 1)), ('SPAN', (5, 0), (5, 1)),
+    ]))
+
+    return [
+        _para('Social Emotional Learning - Time on Task and Skills', _title),
+        table,
+        Spacer(0, 0.1*inch),
+    ]
+
+
+def _attendance_cico(students):
+    names = list(students[:2 * CICO_ROWS])
+    names += [''] * (2 * CICO_ROWS - len(names))
+
+    rows = [[_para(left), '', '', '', _para(right), '', '', '']
+            for left, right in zip(names[:CICO_ROWS], names[CICO_ROWS:])]
+
+    header = ['Student', 'C-I Date', 'C-O Date', 'Goal'] * 2
+    table = Table(
+        [header] + rows,
+        colWidths=[1.5*inch, 0.65*inch, 0.65*inch, 1.0*inch] * 2,
+        rowHeights=[None] + [0.3*inch] * CICO_ROWS,
+    )
+    table.setStyle(_grid)
+
+    return [
+        _para('Attendance - Check In, Check Out', _title),
+        table,
+    ]
@@ -3,10 +3,12 @@ import functools
 from pathlib import Path
 
 import pandas as pd
-from simple_salesforce import (Salesforce, SalesforceExpiredSession,
+from simple_salesforce import (Salesforce, SalesforceError,
+                               SalesforceExpiredSession,
                                SalesforceMalformedRequest)
 
 from .config import SF_PASS, SF_TOKN, SF_URL, SF_USER, YEAR
+from .replica import get_replica
 from .utils import get_sch_ref_df
 
 
@@ -62,8 +64,16 @@ def get_object_fields(object_name):
 
 @check_sf_session
 def get_object_df(object_name, field_list=None, where=None, rename_id=False,
-                  rename_name=False, archive_year=None):
-    if archive_year:
+                  rename_name=False, archive_year=None, local=False):
+    """
+    local: serve from the replica kept current by `change_feed` when it holds
+           the object and can evaluate `where`, otherwise query Salesforce
+    """
+    df = None
+    if local and not archive_year:
+        df = get_replica().read(object_name, field_list, where)
+
+    if df is None and archive_year:
         archive_year = archive_year.upper()
         archive_years = ['SY17', 'SY18', 'SY19']
         if archive_year not in archive_years:
@@ -75,7 +85,7 @@ def get_object_df(object_name, field_list=None, where=None, rename_id=False,
                          f'{archive_year}/{object_name}.csv')
         if field_list:
             df = df[field_list]
-    else:
+    elif df is None:
         if not field_list:
             field_list = get_object_fields(object_name)
 
@@ -104,6 +114,115 @@ def get_object_df(object_name, field_list=None, where=None, rename_id=False,
     return df
 
 
+def get_object_df_in(object_name, field_list, in_field, values,
+                     chunk_size=500, where=None, **kwargs):
+    """ Returns records whose `in_field` is one of `values`, querying in
+    chunks to stay within SOQL's query length limit. Other keyword arguments
+    are passed to `get_object_df`.
+    """
+    values = list(values)
+    if not values:
+        return get_object_df(object_name, field_list,
+                             where=f"{in_field} IN ()", **kwargs)
+
+    chunks = [values[i:i + chunk_size]
+              for i in range(0, len(values), chunk_size)]
+
+    dfs = []
+    for chunk in chunks:
+        chunk_where = f"{in_field} IN {in_str(chunk)}"
+        if where:
+            chunk_where = f"{chunk_where} AND ({where})"
+        dfs.append(get_object_df(object_name, field_list, where=chunk_where,
+                                 **kwargs))
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+@check_sf_session
+def update_records(object_name, records, batch_size=200):
+    """ Updates records through the sObject Collections API, up to
+    `batch_size` (max 200) per request.
+
+    records: DataFrame or list of dicts, each with an 'Id'
+    Returns a DataFrame report with columns Id, success and errors.
+    """
+    if isinstance(records, pd.DataFrame):
+        records = records.to_dict('records')
+
+    results = []
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        response = sf.restful('composite/sobjects', method='PATCH', json={
+            'allOrNone': False,
+            'records': [dict(r, attributes={'type': object_name})
+                        for r in batch],
+        })
+        for record, result in zip(batch, response):
+            results.append({'Id': record['Id'],
+                            'success': result['success'],
+                            'errors': result['errors']})
+
+    n_failed = sum(not r['success'] for r in results)
+    logging.info(f'Updated {len(results) - n_failed} {object_name} records, '
+                 f'{n_failed} failed')
+
+    return pd.DataFrame(results, columns=['Id', 'success', 'errors'])
+
+
+def create_records(object_name, records, batch_size=200):
+    """ Inserts records through the sObject Collections API, up to
+    `batch_size` (max 200) per request.
+
+    records: DataFrame or list of dicts
+    Returns a DataFrame report in the order of `records`, with columns
+    Id (of the new record), success and errors. If a request fails, the
+    records it and the later batches hold are reported as failed, and the
+    batches already inserted keep their Ids.
+    """
+    # Not wrapped in check_sf_session, which would run every batch again.
+    # An expired session is refreshed for the batch it rejected instead.
+    global sf
+
+    if isinstance(records, pd.DataFrame):
+        records = records.to_dict('records')
+
+    results = []
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        payload = {
+            'allOrNone': False,
+            'records': [dict(r, attributes={'type': object_name})
+                        for r in batch],
+        }
+        try:
+            try:
+                response = sf.restful('composite/sobjects', method='POST',
+                                      json=payload)
+            except SalesforceExpiredSession:
+                sf = init_sf_session()
+                response = sf.restful('composite/sobjects', method='POST',
+                                      json=payload)
+        except SalesforceError as e:
+            logging.error(f'Failed to insert {object_name} records '
+                          f'{i + 1}-{len(records)}: {e}')
+            error = {'statusCode': type(e).__name__, 'message': str(e)}
+            results.extend({'Id': None, 'success': False, 'errors': [error]}
+                           for _ in records[i:])
+            break
+
+        for result in response:
+            results.append({'Id': result.get('id'),
+                            'success': result['success'],
+                            'errors': result['errors']})
+
+    n_failed = sum(not r['success'] for r in results)
+    logging.info(f'Created {len(results) - n_failed} {object_name} records, '
+                 f'{n_failed} failed')
+
+    return pd.DataFrame(results, columns=['Id', 'success', 'errors'])
+
+
 def get_section_df(programs):
     if isinstance(programs, str):
         programs = [programs]
@@ -158,14 +277,17 @@ def get_student_section_staff_df(sections_of_interest, schools=None):
         rename_id=True, rename_name=True
     )
 
-    section_df = get_object_df(  # TODO: filter this table by schools as well
-        'Section__c',
-        ['Id', 'Intervention_Primary_Staff__c'],
-        where=f"Program__c IN {in_str(program_df['Program__c'])}",
+    # Only the sections and staff referenced by these enrollments
+    section_df = get_object_df_in(
+        'Section__c', ['Id', 'Intervention_Primary_Staff__c'],
+        'Id', stu_sect_df['Section__c'].dropna().unique(),
         rename_id=True
     )
-    staff_df = get_object_df('Staff__c', ['Id', 'Name'], rename_id=True,
-                             rename_name=True)
+    staff_df = get_object_df_in(
+        'Staff__c', ['Id', 'Name'],
+        'Id', section_df['Intervention_Primary_Staff__c'].dropna().unique(),
+        rename_id=True, rename_name=True
+    )
 
     # merge salesforce tables
     df = (stu_sect_df.merge(section_df, how='left', on='Section__c')
@@ -234,6 +356,33 @@ def get_student_df(schools=None):
     return student_df
 
 
+def get_students_by_local_id(local_ids, chunk_size=500):
+    """ Returns the students whose Local_Student_ID__c is one of `local_ids`,
+    with the same columns as `get_student_df`. Only the given IDs are
+    queried, in chunks of `chunk_size`, so this stays fast however many
+    students the org holds.
+    """
+    local_ids = {str(i).strip() for i in local_ids if pd.notnull(i)}
+
+    return get_object_df_in(
+        'Student__c',
+        ['Id', 'Local_Student_ID__c', 'External_Id__c'],
+        'Local_Student_ID__c', sorted(local_ids),
+        chunk_size=chunk_size,
+        rename_name=True,
+        rename_id=True
+    )
+
+
+@check_sf_session
+def is_filterable(object_name, field):
+    """ Returns whether `field` can be used in a SOQL WHERE clause; long text
+    areas, for one, cannot.
+    """
+    fields = getattr(sf, object_name).describe()['fields']
+    return any(f['name'] == field and f['filterable'] for f in fields)
+
+
 @check_sf_session
 def object_reference():
     result = sf.describe()
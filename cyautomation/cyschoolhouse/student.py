@@ -1,14 +1,25 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from time import sleep
+from tempfile import NamedTemporaryFile
+from time import monotonic, sleep
 
 import numpy as np
 import pandas as pd
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
 
 from . import simple_cysh as cysh
-from .cyschoolhousesuite import get_driver, open_cyschoolhouse
-from .config import INPUT_PATH, YEAR, SF_URL, TEMP_PATH
+from .browser_pool import BrowserPool
+from .browser_service import lease_driver
+from .config import INPUT_PATH, SF_URL, SF_USER, STATE_PATH, TEMP_PATH, YEAR
 from .sendemail import send_email
+from .waits import wait_for, wait_page_settled
 
 
 def _sf_api_approach(xlsx_path):
@@ -16,16 +27,14 @@ def _sf_api_approach(xlsx_path):
     if we could edit the fields:
     """
     df = pd.read_excel(xlsx_path)
-    school_df = cysh.get_object_df('Account', ['Id', 'Name'])
+    schools = cysh.in_str(df['School'].unique())
+    school_df = cysh.get_object_df('Account', ['Id', 'Name'],
+                                   where=f"Name IN {schools}")
     df = df.merge(school_df, how='left', left_on='School', right_on='Name')
 
-    drop_ids = []
-    for index, row in df.iterrows():
-        search_result = cysh.sf.query('SELECT Id FROM Student__c WHERE '
-                                      f"Local_Student_ID__c = '{row['Student CPS ID']}'")
-        if len(search_result['records']) > 0:
-            drop_ids.append(row['Student CPS ID'])
-    df = df.loc[~df['Student CPS ID'].isin(drop_ids)]
+    extant_df = cysh.get_students_by_local_id(df['Student CPS ID'])
+    df = df.loc[~df['Student CPS ID'].astype(str).str.strip()
+                  .isin(extant_df['Local_Student_ID__c'])]
 
     for index, row in df.iterrows():
         stu_dict = {
@@ -40,85 +49,413 @@ def _sf_api_approach(xlsx_path):
     return None
 
 
+UPLOAD_STAGES = ['validate', 'dedupe', 'upload', 'await', 'publish']
+UPLOAD_PROGRESS_PATH = Path(STATE_PATH) / f'{YEAR} Student Upload.json'
+
+REQUIRED_COLUMNS = [
+    '*REQ* Student Id',
+    '*REQ* Local Student ID',
+    '*REQ* First Name',
+    '*REQ* Last Name',
+    '*REQ* Grade',
+    '*REQ* Entry Date',
+]
+BATCH_DONE_STATUSES = ['Completed', 'Failed', 'Aborted']
+
+# Batch jobs are matched to the click that started them. Clicks are made one
+# at a time, and each click ignores the jobs that existed before it; waiting
+# for the jobs to appear happens outside the lock. The Apex classes of the
+# jobs each kind of click started are kept, so a late job of another kind
+# is not claimed by the wrong click.
+_batch_lock = threading.Lock()
+_claimed_jobs = set()
+_batch_classes = {}
+
+
 def upload_all(enrollment_date, xlsx_dir=INPUT_PATH,
-               xlsx_name='New Students for cyschoolhouse.xlsx', sf=cysh.sf):
+               xlsx_name='New Students for cyschoolhouse.xlsx', sf=cysh.sf,
+               n_workers=1, profile='default', restart=False):
     """ Runs the entire student upload process.
+
+    Each school goes through UPLOAD_STAGES: validate the rows, drop students
+    already in cyschoolhouse, upload the CSV, wait for the loader's batch
+    jobs to finish, and publish. Progress is saved after every stage at
+    `UPLOAD_PROGRESS_PATH`, so running again with the same spreadsheet
+    resumes each school at the stage it failed at.
+
+    n_workers: schools to upload at once, each in its own headless browser
+    profile: driver profile of the browsers, see `get_driver`
+    restart: ignore saved progress and start every school from the beginning
+
+    Returns a DataFrame with the stage each school reached and any error.
     """
     xlsx_path = str(Path(xlsx_dir) / xlsx_name)
 
     sdnt_df = import_parameters(xlsx_path, enrollment_date)
-    sdnt_df = remove_extant_students(sdnt_df)
     sdnt_df = sdnt_df.rename(columns={'School': 'Informal Name'})
     sch_ref_df = cysh.get_sch_ref_df()
     sdnt_df = sdnt_df.merge(sch_ref_df[['School', 'Informal Name']],
                             how='left', on='Informal Name')
 
-    setup_df = cysh.get_object_df('Setup__c', ['Id', 'School__c'],
-                                  rename_id=True, rename_name=True)
-    school_df = cysh.get_object_df('Account', ['Id', 'Name'])
-    setup_df = setup_df.merge(school_df, how='left', left_on='School__c',
-                              right_on='Id')
-    setup_df = setup_df.loc[~setup_df['Id'].isnull()]
-
     if len(sdnt_df) == 0:
         print(f'No new students to upload.')
         return None
 
-    driver = get_driver()
-    open_cyschoolhouse(driver)
+    unmatched = sdnt_df.loc[sdnt_df['School'].isnull(), 'Informal Name']
+    for informal_name in unmatched.unique():
+        print(f'Skipping students of unknown school: {informal_name}')
+    sdnt_df = sdnt_df.loc[sdnt_df['School'].notnull()]
+
+    schools = cysh.in_str(sdnt_df['School'].unique())
+    school_df = cysh.get_object_df('Account', ['Id', 'Name'],
+                                   where=f"Name IN {schools}")
+    setup_df = cysh.get_object_df(
+        'Setup__c', ['Id', 'School__c'], rename_id=True, rename_name=True,
+        where=f"School__c IN {cysh.in_str(school_df['Id'])}"
+    )
+    setup_df = setup_df.merge(school_df, how='left', left_on='School__c',
+                              right_on='Id')
+    setup_ids = dict(zip(setup_df['Name'], setup_df['Setup__c']))
+
+    progress = UploadProgress(_upload_run_id(xlsx_path, enrollment_date),
+                              restart=restart)
+    previous = progress.report()
+    published_before = set(
+        previous.loc[previous['stage'] == 'publish', 'School'])
+    uploads = [(school_name, df, setup_ids.get(school_name), progress)
+               for school_name, df in sdnt_df.groupby('School')]
+
+    if n_workers > 1:
+        pool = BrowserPool(n_workers, max_retries=0, profile=profile)
+        pool.map(lambda driver, upload: run_upload_stages(driver, *upload),
+                 uploads)
+    else:
+        driver = lease_driver(profile)
+        for upload in uploads:
+            try:
+                run_upload_stages(driver, *upload)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                logging.warning(f'Upload failed for {upload[0]}: {e}')
+        driver.quit()
+
+    report = progress.report()
+    for _, row in report.loc[report['error'].notnull()].iterrows():
+        print(f"Upload failed for {row['School']}: {row['error']}")
+
+    # Email school manager to inform of successful student upload, once:
+    # schools published by an earlier run were emailed then
+    published = report.loc[(report['stage'] == 'publish') &
+                           (report['students'] > 0) &
+                           ~report['School'].isin(published_before), 'School']
+    if len(published) == 0:
+        return report
 
-    for school_name, df in sdnt_df.groupby('School'):
-        # Write csv
-        path_to_csv = (
-            Path(TEMP_PATH)
-            / f"{YEAR} New Students for CYSH - {school_name}.csv"
-        )
+    staff_df = cysh.get_staff_df()
+    staff_df = staff_df.loc[staff_df['Role__c'].str.lower()=='impact manager']
 
-        (df.drop(columns=["School"])
-           .to_csv(path_to_csv, index=False, date_format='%m/%d/%Y'))
+    to_addrs = staff_df.loc[staff_df['School'].isin(published), 'Email__c']
+    to_addrs = to_addrs.unique().tolist()
 
-        # Navigatge to student enrollment page
-        setup_id = setup_df.loc[setup_df['Name']==school_name, 'Setup__c'].values[0]
-        driver.get(
-            f"{SF_URL}/apex/CT_core_LoadCsvData_v2?setupId={setup_id}"
-            "&OldSideBar=true&type=Student"
-        )
-        sleep(2)
+    send_email(
+        to_addrs = to_addrs,
+        subject = 'New students now in cyschoolhouse',
+        body = ('The students you submitted have been successfully uploaded '
+                'to cyschoolhouse.')
+    )
 
-        input_file(driver, path_to_csv)
-        sleep(2)
+    return report
 
-        insert_data(driver)
-        sleep(2)
 
-        # Publish
-        # Seems to work, but not completely sure if script
-        # pauses until upload is complete, both for the "Insert Data"
-        # phase, and the "Publish Staff/Student Records" phase.
+def run_upload_stages(driver, school_name, df, setup_id, progress):
+    """ Moves one school through UPLOAD_STAGES, starting after the last
+    stage `progress` has recorded as done. Raises on the first failed stage.
+    """
+    state = progress.get(school_name)
+    deduped = state.get('local_ids') is not None
+    if deduped:
+        df = df.loc[_local_ids(df).isin(state['local_ids'])]
+
+    done = state.get('stage')
+    start = UPLOAD_STAGES.index(done) + 1 if done else 0
+    if start == len(UPLOAD_STAGES):
+        return
+
+    # A failed upload may have loaded some of the students, so look for
+    # them again before retrying it
+    if UPLOAD_STAGES[start] == 'upload':
+        start = UPLOAD_STAGES.index('dedupe')
+
+    skip = set()
+    for stage in UPLOAD_STAGES[start:]:
+        if stage in skip:
+            continue
+        progress.update(school_name, running=stage, error=None)
+        try:
+            if stage == 'validate':
+                validate_students(df, setup_id)
+            elif stage == 'dedupe':
+                df = remove_extant_students(df)
+                if deduped:
+                    # Retrying a failed upload: local_ids keeps every
+                    # student of the school for the report
+                    if len(df) == 0:
+                        skip.update(['upload', 'await'])
+                else:
+                    progress.update(school_name,
+                                    local_ids=_local_ids(df).tolist())
+                    if len(df) == 0:
+                        print(f'No new students to upload for {school_name}')
+                        progress.update(school_name, stage='publish',
+                                        running=None)
+                        return
+            elif stage == 'upload':
+                jobs = upload_school(driver, school_name, df, setup_id)
+                progress.update(school_name, jobs=jobs)
+            elif stage == 'await':
+                await_batch_jobs(progress.get(school_name)['jobs'])
+            elif stage == 'publish':
+                publish_school(driver, setup_id)
+        except Exception as e:
+            progress.update(school_name, running=None,
+                            error=f'{stage}: {e}')
+            raise
+
+        progress.update(school_name, stage=stage, running=None)
+
+    print(f"Uploaded {len(df)} students to {school_name}")
+
+
+def validate_students(df, setup_id):
+    """ Raises a ValueError describing every problem found in one school's
+    upload rows.
+    """
+    problems = []
+    if not setup_id:
+        problems.append('school has no Setup__c record')
+
+    for col in REQUIRED_COLUMNS:
+        n_missing = df[col].isnull().sum()
+        if n_missing:
+            problems.append(f'{n_missing} rows missing {col}')
 
-        driver.get(f'{SF_URL}/apex/schoolsetup_staff?setupId={setup_id}')
-        driver.find_element_by_css_selector('input.red_btn').click()
-        sleep(3)
+    duplicated = _local_ids(df)[_local_ids(df).duplicated()].unique()
+    if len(duplicated):
+        problems.append(f"duplicate local IDs {', '.join(duplicated)}")
 
-        print(f"Uploaded {len(df)} students")
+    grades = pd.to_numeric(df['*REQ* Grade'], errors='coerce')
+    if (grades.isnull() | (grades % 1 != 0)).any():
+        problems.append('non-integer grades')
 
+    dates = pd.to_datetime(df['*REQ* Entry Date'], errors='coerce')
+    if dates.isnull().any():
+        problems.append('unreadable entry dates')
+
+    if problems:
+        raise ValueError('; '.join(problems))
+
+
+def upload_school(driver, school_name, df, setup_id):
+    """ Loads one school's new students through the CSV loader. Returns the
+    Ids of the batch jobs the load started.
+    """
+    # Write csv
+    path_to_csv = (
+        Path(TEMP_PATH)
+        / f"{YEAR} New Students for CYSH - {school_name}.csv"
+    )
+
+    (df.drop(columns=["School"])
+       .to_csv(path_to_csv, index=False, date_format='%m/%d/%Y'))
+
+    # Navigatge to student enrollment page
+    driver.get(
+        f"{SF_URL}/apex/CT_core_LoadCsvData_v2?setupId={setup_id}"
+        "&OldSideBar=true&type=Student"
+    )
+    wait_for(driver, EC.presence_of_element_located((By.ID, 'selectedFile')),
+             'student.upload_page')
+
+    input_file(driver, path_to_csv)
+    wait_for(driver,
+             EC.element_to_be_clickable((By.ID, 'startBatchButton')),
+             'student.file_loaded')
+
+    try:
+        return start_batch(driver, lambda: insert_data(driver),
+                           'student.insert_data')
+    finally:
         path_to_csv.unlink()
 
-    # Email school manager to inform of successful student upload
-    staff_df = cysh.get_staff_df()
-    staff_df = staff_df.loc[staff_df['Role__c'].str.lower()=='impact manager']
 
-    to_addrs = staff_df.loc[staff_df['School'].isin(sdnt_df['School']), 'Email__c']
-    to_addrs = to_addrs.unique().tolist()
+def publish_school(driver, setup_id):
+    """ Publishes a school's staff and student records, waiting for any
+    batch jobs the publish starts.
+    """
+    driver.get(f'{SF_URL}/apex/schoolsetup_staff?setupId={setup_id}')
+    button = driver.find_element_by_css_selector('input.red_btn')
+    jobs = start_batch(driver, button.click, 'student.publish',
+                       required=False)
+    await_batch_jobs(jobs)
 
-    send_email(
-        to_addrs = to_addrs,
-        subject = 'New students now in cyschoolhouse',
-        body = ('The students you submitted have been successfully uploaded '
-                'to cyschoolhouse.')
+
+def start_batch(driver, click, name, required=True, appear_timeout=30):
+    """ Clicks something that starts Apex batch jobs and returns the Ids of
+    the new BatchApex jobs run by `SF_USER`. Once a `name` click has started
+    jobs, later ones only claim jobs of the same Apex classes; until then,
+    jobs of classes other kinds of click started are left alone.
+
+    required: raise if no job appears within `appear_timeout` seconds
+    """
+    # Leeway for the difference between our clock and Salesforce's
+    since = datetime.now(timezone.utc) - timedelta(seconds=60)
+    with _batch_lock:
+        # Jobs started by earlier clicks exist once their page has settled
+        existing = set(get_batch_jobs(since=since)['Id'])
+        click()
+        wait_page_settled(driver, name)
+
+    deadline = monotonic() + appear_timeout
+    while True:
+        jobs = get_batch_jobs(since=since)
+        jobs = jobs.loc[~jobs['Id'].isin(existing)]
+        with _batch_lock:
+            jobs = _unclaimed_jobs(jobs, name)
+            if len(jobs):
+                _claimed_jobs.update(jobs['Id'])
+                _batch_classes.setdefault(name, set()).update(
+                    jobs['ApexClassId'])
+                break
+        if monotonic() > deadline:
+            break
+        sleep(2)
+
+    job_ids = jobs['Id'].tolist()
+
+    if required and not job_ids:
+        raise RuntimeError(f'{name} did not start a batch job')
+
+    return job_ids
+
+
+def _unclaimed_jobs(jobs, name):
+    """ Returns the jobs no click has claimed that a `name` click may have
+    started. Call with `_batch_lock` held.
+    """
+    jobs = jobs.loc[~jobs['Id'].isin(_claimed_jobs)]
+    own_classes = _batch_classes.get(name)
+    if own_classes:
+        return jobs.loc[jobs['ApexClassId'].isin(own_classes)]
+
+    other_classes = set().union(*(
+        classes for other, classes in _batch_classes.items()
+        if other != name
+    ))
+    return jobs.loc[~jobs['ApexClassId'].isin(other_classes)]
+
+
+def get_batch_jobs(since=None, job_ids=None):
+    """ Returns BatchApex jobs run by `SF_USER`, either those created since
+    the datetime `since` or those with the given Ids.
+    """
+    where = f"JobType = 'BatchApex' AND CreatedBy.Username = '{SF_USER}'"
+    if since is not None:
+        where += f" AND CreatedDate >= {since:%Y-%m-%dT%H:%M:%SZ}"
+    if job_ids is not None:
+        where += f" AND Id IN {cysh.in_str(job_ids)}"
+
+    return cysh.get_object_df(
+        'AsyncApexJob',
+        ['Id', 'ApexClassId', 'Status', 'JobItemsProcessed', 'TotalJobItems',
+         'NumberOfErrors', 'ExtendedStatus'],
+        where=where
     )
 
-    driver.quit()
+
+def await_batch_jobs(job_ids, timeout=1800, poll_interval=10):
+    """ Polls batch jobs until they have all finished, raising if any of them
+    failed, were aborted or reported errors.
+    """
+    if not job_ids:
+        return
+
+    deadline = monotonic() + timeout
+    while True:
+        jobs = get_batch_jobs(job_ids=job_ids)
+        if len(jobs) == len(job_ids) and \
+                jobs['Status'].isin(BATCH_DONE_STATUSES).all():
+            break
+        if monotonic() > deadline:
+            raise TimeoutError(f'Batch jobs still running after {timeout}s: '
+                               f"{', '.join(job_ids)}")
+        sleep(poll_interval)
+
+    failed = jobs.loc[(jobs['Status'] != 'Completed') |
+                      (jobs['NumberOfErrors'] > 0)]
+    if len(failed):
+        raise RuntimeError('; '.join(
+            f"{row['Id']} {row['Status']} with {row['NumberOfErrors']} "
+            f"errors: {row['ExtendedStatus']}"
+            for _, row in failed.iterrows()
+        ))
+
+
+class UploadProgress:
+    """Stage reached by each school in a student upload, saved as JSON so an
+    interrupted run can resume. Progress is kept per spreadsheet and
+    enrollment date; a different `run_id` starts over.
+    """
+
+    def __init__(self, run_id, path=UPLOAD_PROGRESS_PATH, restart=False):
+        self.path = Path(path)
+        self.run_id = run_id
+        self.schools = {}
+        self._lock = threading.Lock()
+
+        if self.path.exists() and not restart:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('run_id') == run_id:
+                self.schools = saved['schools']
+                logging.info(f'Resuming student upload from {self.path}')
+
+    def get(self, school_name):
+        with self._lock:
+            return dict(self.schools.get(school_name, {}))
+
+    def update(self, school_name, **fields):
+        with self._lock:
+            self.schools.setdefault(school_name, {}).update(fields)
+            self._save()
+
+    def report(self):
+        with self._lock:
+            rows = [
+                {'School': name, 'stage': state.get('stage'),
+                 'students': len(state.get('local_ids') or []),
+                 'error': state.get('error')}
+                for name, state in self.schools.items()
+            ]
+        return pd.DataFrame(rows, columns=['School', 'stage', 'students',
+                                           'error'])
+
+    def _save(self):
+        with NamedTemporaryFile('w', dir=self.path.parent,
+                                delete=False) as f:
+            json.dump({'run_id': self.run_id, 'schools': self.schools}, f,
+                      indent=2)
+        os.replace(f.name, self.path)
+
+
+def _upload_run_id(xlsx_path, enrollment_date):
+    with open(xlsx_path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return f'{digest}:{enrollment_date}'
+
+
+def _local_ids(df):
+    return df['*REQ* Local Student ID'].astype(str).str.strip()
 
 
 def import_parameters(xlsx_path, enrollment_date):
@@ -169,10 +506,11 @@ def import_parameters(xlsx_path, enrollment_date):
 
 
 def remove_extant_students(df):
-    student_df = cysh.get_student_df()
-    df = df.loc[
-        ~df['*REQ* Local Student ID'].isin(student_df['Local_Student_ID__c'])
-    ]
+    """ Drops students whose local ID is already in cyschoolhouse, looking up
+    only the IDs in `df`.
+    """
+    student_df = cysh.get_students_by_local_id(_local_ids(df))
+    df = df.loc[~_local_ids(df).isin(student_df['Local_Student_ID__c'])]
     return df
 
 
@@ -1,3 +1,5 @@
+import pandas as pd
+
 from . import simple_cysh as cysh
 
 
@@ -13,28 +15,117 @@ def enrollment_sync(source_section, destination_section, enrollment_start_date,
         raise ValueError(f'source_section and destination_section '
                          'must be strings.')
 
+    section_df, stu_sec_df = get_enrollment_snapshot(
+        [source_section, destination_section]
+    )
+    to_enroll_df = plan_enrollment_sync(section_df, stu_sec_df,
+                                        source_section, destination_section,
+                                        ACM_to_TL)
+
+    print(f"Enrolling {len(to_enroll_df)} students from {source_section} to "
+          f"{destination_section} sections.")
+
+    results = []
+    for index, row in to_enroll_df.iterrows():
+        result = create_one(
+            student__c=row['Student__c'],
+            section__c=row['Section__c_to_Enroll'],
+            enrollment_start_date=enrollment_start_date
+        )
+        results.append(result)
+
+    return results
+
+
+def enrollment_sync_many(pairs, enrollment_start_date):
+    """ Runs several enrollment syncs from one snapshot of enrollments and
+    creates all the new enrollments in batched writes.
+
+    pairs: list of (source_section, destination_section) or
+           (source_section, destination_section, ACM_to_TL) tuples. Pairs
+           are planned in order, and students planned into a destination
+           section by an earlier pair count as enrolled there for later
+           pairs, so no enrollment is made twice.
+
+    Returns the planned enrollments with the Id, success and errors of each
+    created record.
+    """
+    pairs = [tuple(pair) + (False,) * (3 - len(pair)) for pair in pairs]
+    programs = {program for pair in pairs for program in pair[:2]}
+    section_df, stu_sec_df = get_enrollment_snapshot(sorted(programs))
+
+    plans = []
+    for source_section, destination_section, ACM_to_TL in pairs:
+        to_enroll_df = plan_enrollment_sync(section_df, stu_sec_df,
+                                            source_section,
+                                            destination_section, ACM_to_TL)
+        print(f"Enrolling {len(to_enroll_df)} students from {source_section} "
+              f"to {destination_section} sections.")
+
+        plan_df = pd.DataFrame({
+            'source_section': source_section,
+            'destination_section': destination_section,
+            'Student__c': to_enroll_df['Student__c'],
+            'Section__c': to_enroll_df['Section__c_to_Enroll'],
+        })
+        plans.append(plan_df)
+        stu_sec_df = pd.concat([stu_sec_df,
+                                plan_df[['Student__c', 'Section__c']]],
+                               ignore_index=True)
+
+    plan_df = pd.concat(plans, ignore_index=True)
+    if len(plan_df) == 0:
+        return plan_df.assign(Id=None, success=None, errors=None)
+
+    results = cysh.create_records('Student_Section__c', [
+        {
+            'Student__c': row['Student__c'],
+            'Intervention_Enrollment_Start_Date__c': enrollment_start_date,
+            'Enrollment_Start_Date__c': enrollment_start_date,
+            'Section__c': row['Section__c'],
+        }
+        for _, row in plan_df.iterrows()
+    ])
+
+    return pd.concat([plan_df, results], axis=1)
+
+
+def get_enrollment_snapshot(programs):
+    """ Returns the sections of the given programs (section types), and the
+    Student__c/Section__c pairs of the enrollments in them.
+    """
     program_df = cysh.get_object_df('Program__c', ['Id', 'Name'],
                                     rename_id=True, rename_name=True)
 
-    for x in [source_section, destination_section]:
-        section_types = program_df['Program__c_Name'].tolist()
+    section_types = program_df['Program__c_Name'].tolist()
+    for x in programs:
         if x not in section_types:
             raise ValueError(f'{x} is not a valid section type. '
                              f'Try one of: {section_types}')
 
-    stu_sec_df = cysh.get_object_df('Student_Section__c',
-                                    ['Id', 'Student__c', 'Section__c'])
+    program_df = program_df.loc[program_df['Program__c_Name'].isin(programs)]
+    program_ids = cysh.in_str(program_df['Program__c'])
+
     section_df = cysh.get_object_df('Section__c',
                                     ['Id', 'Name', 'School__c', 'Program__c',
                                     'Intervention_Primary_Staff__c'],
+                                    where=f"Program__c IN {program_ids}",
                                     rename_id=True, rename_name=True)
+    section_df = section_df.merge(program_df, how='left', on='Program__c')
 
-    school_df = cysh.get_object_df('Account', ['Id', 'Name'])
-    school_df = school_df.rename(columns={'Id':'School__c', 'Name':'School'})
+    stu_sec_df = cysh.get_object_df(
+        'Student_Section__c', ['Student__c', 'Section__c'],
+        where=f"Section__r.Program__c IN {program_ids}"
+    )
 
-    section_df = section_df.merge(school_df, how='left', on='School__c')
-    section_df = section_df.merge(program_df, how='left', on='Program__c')
+    return section_df, stu_sec_df
 
+
+def plan_enrollment_sync(section_df, stu_sec_df, source_section,
+                         destination_section, ACM_to_TL=False):
+    """ Returns the students to enroll in `destination_section` sections,
+    with the section to enroll each in as 'Section__c_to_Enroll'.
+    """
     stu_sec_df = stu_sec_df.merge(section_df, how='left', on='Section__c')
 
     # get students enrolled in source section
@@ -49,7 +140,7 @@ def enrollment_sync(source_section, destination_section, enrollment_start_date,
 
     # get students enrolled in source section but not destination section
     if ACM_to_TL:
-        key_cols = ['Student__c', 'School']
+        key_cols = ['Student__c', 'School__c']
     else:
         key_cols = ['Student__c', 'Intervention_Primary_Staff__c']
 
@@ -86,19 +177,8 @@ def enrollment_sync(source_section, destination_section, enrollment_start_date,
         ~to_enroll_df['Section__c_to_Enroll'].isnull()
     ]
 
-    print(f"Enrolling {len(to_enroll_df)} students from {source_section} to "
-          f"{destination_section} sections.")
-
-    results = []
-    for index, row in to_enroll_df.iterrows():
-        result = create_one(
-            student__c=row['Student__c'],
-            section__c=row['Section__c_to_Enroll'],
-            enrollment_start_date=enrollment_start_date
-        )
-        results.append(result)
-
-    return results
+    return to_enroll_df.drop_duplicates(['Student__c',
+                                         'Section__c_to_Enroll'])
 
 
 def create_one(student__c, section__c, enrollment_start_date, sf=cysh.sf):
@@ -1,11 +1,74 @@
+import hashlib
+import json
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
+import numpy as np
 import pandas as pd
 
 from . import simple_cysh as cysh
-from .config import TEMP_PATH, YEAR
-from .utils import get_sch_ref_df
+from .config import STATE_PATH, TEMP_PATH, YEAR
+from .utils import (df_hash, get_sch_ref_df, load_publish_manifest,
+                    publish_file, update_publish_manifest, write_xlsx)
+
+SITE_RULES_PATH = Path(f"Z:/ChiPrivate/Chicago Data and Evaluation/{YEAR}/"
+                       f"{YEAR} ToT Audit Rules.xlsx")
+
+# Common spellings of tier codes, standardized by `fix_T1T2ELT_typos`
+TYPO_PATTERNS = {
+    'T1': r'[Tt](?:[Ii][Ee]|[Ee][Ii])[Rr] ?(?:1|[Oo][Nn][Ee])|t1',
+    'T2': r'[Tt](?:[Ii][Ee]|[Ee][Ii])[Rr] ?(?:2|[Tt][Ww][Oo])|t2',
+#     'ELT': r'([Aa]fter ?[Ss]chool|ASP)',
+}
+TYPO_REGEX = re.compile('|'.join(f'(?P<{code}>{pattern})'
+                                 for code, pattern in TYPO_PATTERNS.items()))
+
+# Misspellings that pick out sessions to fix in SOQL. LIKE ignores case, so
+# lowercase 't1' and 't2' would match every correct "T1" and "T2"; those are
+# fixed in the sessions the audit downloads instead.
+TYPO_LIKE_TERMS = ['tier', 'teir']
+
+# Errors found by the last incremental audit, and when it queried
+AUDIT_STATE_PATH = Path(STATE_PATH) / f'{YEAR} ToT Audit Errors.pkl'
+
+# Salesforce only reports deleted records from the last 30 days
+MAX_INCREMENTAL_AGE = timedelta(days=29)
+
+# Objects merged into every session result; a change to any of them may
+# change errors of results that did not change themselves
+LOOKUP_OBJECTS = ['Section__c', 'Staff__c', 'Program__c', 'Account']
+
+# Audit rules. Each rule flags the rows that meet all of its conditions:
+#   program_contains: regex searched in the program name
+#   program_in: program names
+#   comments_match: regexes that must all be found in the comment
+#   comments_lack: regex that must not be found in the comment
+#   min_minutes: flags time below this many minutes
+#   max_minutes: flags time above this many minutes
+#   session_after_submission: flags sessions dated after they were logged
+ERROR_RULES = [
+    {'name': 'Missing T1/T2 Code',
+     'program_contains': 'Tutoring',
+     'comments_lack': 'T1|T2'},
+    {'name': 'Listed T1 and T2',
+     'program_contains': 'Tutoring',
+     'comments_match': ['T1', 'T2']},
+    {'name': '<10 Minutes',
+     'program_in': ['SEL Check In Check Out', 'Coaching: Attendance',
+                    'Tutoring: Math', 'Tutoring: Literacy'],
+     'min_minutes': 10},
+    {'name': '>120 Minutes',
+     'program_contains': 'Tutoring',
+     'max_minutes': 120},
+    {'name': 'Logged in Future',
+     'session_after_submission': True},
+    {'name': 'Wrong Section',
+     'program_in': ['DESSA', 'Math Inventory', 'Reading Inventory']},
+]
 
 
 class ToTAudit:
@@ -29,23 +92,17 @@ class ToTAudit:
         )
         self.sch_ref_df = self.sch_ref_df.set_index('School')
 
-    def deploy_all(self):
+    def deploy_all(self, incremental=False, rebuild=False):
         """ Fixes typos and distributes audit for all school teams.
 
-        Returns a summary dataframe.
+        Returns a summary dataframe. See `get_errors_df` for `incremental`
+        and `rebuild`.
         """
         self.fix_T1T2ELT_typos()
-        errors_df = self.get_errors_df()
+        errors_df = self.get_errors_df(incremental=incremental,
+                                       rebuild=rebuild)
 
-        for school in self.sch_ref_df.index:
-            write_path = self.sch_ref_df.loc[school, 'tracker_path']
-
-            if not write_path.parent.exists() and self.test:
-                write_path.parent.mkdir(parents=True)
-
-            (errors_df.loc[errors_df['School'] == school]
-                      .drop(columns='School')
-                      .to_excel(write_path, index=False))
+        self.write_school_workbooks(errors_df)
 
         # write aggregate table
         counts = (errors_df.groupby(['School', 'Error'])['ACM']
@@ -56,65 +113,242 @@ class ToTAudit:
                         'ToT Audit Error Counts.xlsx')
         return counts
 
-    def fix_T1T2ELT_typos(self):
-        df = self.get_T1T2ELT_typo_fixes_df()
+    def write_school_workbooks(self, errors_df, max_workers=8):
+        """ Writes each school's errors to its workbook. The table is
+        partitioned once, workbooks are staged locally and copied to the
+        share in parallel, and schools whose errors match the last published
+        workbook are skipped.
 
-        if df.empty:
-            return None
+        Returns a list of the paths written.
+        """
+        manifest = load_publish_manifest()
+        partitions = dict(tuple(errors_df.groupby('School')))
+        no_errors_df = errors_df.iloc[0:0]
+
+        written = []
+        published = {}
+        with TemporaryDirectory() as stage_dir, \
+                ThreadPoolExecutor(max_workers) as pool:
+            futures = {}
+            for school in self.sch_ref_df.index:
+                write_path = self.sch_ref_df.loc[school, 'tracker_path']
+                df = (partitions.get(school, no_errors_df)
+                                .drop(columns='School'))
+
+                digest = df_hash(df)
+                if write_path.exists() and \
+                        manifest.get(str(write_path)) == digest:
+                    continue
+
+                if not write_path.parent.exists() and self.test:
+                    write_path.parent.mkdir(parents=True)
+
+                staged_path = Path(stage_dir) / write_path.name
+                future = pool.submit(_stage_and_publish, df, staged_path,
+                                     write_path)
+                futures[future] = (write_path, digest)
+
+            for future in as_completed(futures):
+                write_path, digest = futures[future]
+                try:
+                    future.result()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception:
+                    logging.exception(f"Failed to write {write_path.name}")
+                else:
+                    published[str(write_path)] = digest
+                    written.append(write_path)
+
+        update_publish_manifest(published)
+        logging.info(f"Wrote {len(written)} ToT audit workbooks, skipped "
+                     f"{len(self.sch_ref_df) - len(futures)} unchanged")
+
+        return written
 
-        logging.info(f"Fixing {len(df)} T1, T2, or ELT typos")
+    def fix_T1T2ELT_typos(self):
+        """ Writes standardized tier codes back to session comments in
+        batches. Returns a report with one row per updated session.
+        """
+        return write_typo_fixes(self.get_T1T2ELT_typo_fixes_df())
 
-        for _, row in df.iterrows():
-            result = cysh.sf.Intervention_Session__c.update(
-                row.Intervention_Session__c,
-                {'Comments__c':row['Comments__c_fixed']}
+    @staticmethod
+    def get_T1T2ELT_typo_fixes_df(sessions_df=None):
+        """ Standardize common spellings of "T1" "T2" and "ELT"
+
+        sessions_df: sessions to check, with Intervention_Session__c and
+                     Comments__c; by default those whose comments contain a
+                     `TYPO_LIKE_TERMS` misspelling
+        """
+        if sessions_df is None:
+            where = None
+            if cysh.is_filterable('Intervention_Session__c', 'Comments__c'):
+                where = ' OR '.join(f"Comments__c LIKE '%{term}%'"
+                                    for term in TYPO_LIKE_TERMS)
+            else:
+                logging.warning('Session comments cannot be filtered in '
+                                'SOQL, scanning all sessions for typos')
+            sessions_df = cysh.get_object_df(
+                'Intervention_Session__c',
+                ['Id', 'Comments__c'],
+                where=where,
+                rename_id=True
             )
 
-            if not isinstance(result, int) or result != 204:
-                logging.warning(
-                    f'T1, T2, ELT fix failed for '
-                    f'{row.Intervention_Session__c}: {result}'
-                )
+        df = sessions_df.loc[sessions_df['Comments__c'].notna(),
+                             ['Intervention_Session__c', 'Comments__c']]
+        fixed = df['Comments__c'].astype(str).str.replace(
+            TYPO_REGEX, lambda m: m.lastgroup, regex=True
+        )
+        df = df.assign(Comments__c_fixed=fixed)
+        df = df.loc[df['Comments__c_fixed'] != df['Comments__c']]
+
+        return df
 
     @staticmethod
-    def get_T1T2ELT_typo_fixes_df():
-        """ Standardize common spellings of "T1" "T2" and "ELT"
+    def get_errors_df(incremental=False, rebuild=False):
         """
-        typo_map = {
-            'T1': r'[Tt](?:[Ii][Ee]|[Ee][Ii])[Rr] ?(?:1|[Oo][Nn][Ee])|t1',
-            'T2': r'[Tt](?:[Ii][Ee]|[Ee][Ii])[Rr] ?(?:2|[Tt][Ww][Oo])|t2',
-        #     'ELT': r'([Aa]fter ?[Ss]chool|ASP)',
+        incremental: evaluate only session results created or modified since
+                     the last incremental run, and merge them into the error
+                     table stored at `AUDIT_STATE_PATH`
+        rebuild: with `incremental`, discard the stored table and evaluate
+                 every session result
+        """
+        if incremental:
+            df = ToTAudit._get_incremental_errors_df(rebuild=rebuild)
+        else:
+            df = ToTAudit._get_session_results_df()
+            rules = ERROR_RULES + load_error_rules()
+            df['Error'] = evaluate_error_rules(df, rules)
+            df = df.loc[df['Error'] != '']
+
+        accepted_errors_df = pd.read_excel((
+            f"Z:/ChiPrivate/Chicago Data and Evaluation/{YEAR}/"
+            f"{YEAR} ToT Audit Accepted Errors.xlsx"
+        ))
+
+        df = df.loc[~df['Intervention_Session__c_Name'].isin(
+            accepted_errors_df['SESSION_ID'])]
+
+        col_friendly_names = {
+            'School_Name__c':'School',
+            'Staff__c_Name':'ACM',
+            'Program__c_Name':'Program',
+            'Intervention_Session__c_Name':'Session ID',
+            'Related_Student_s_Name__c':'Student',
+            'CreatedDate':'Submission Date',
+            'Intervention_Session_Date__c':'Session Date',
+            'Amount_of_Time__c':'ToT',
+            #'Comments__c':'Comment',
+            'Error':'Error',
         }
 
-        all_typos = '|'.join(list(typo_map.values()))
+        df = (df.rename(columns=col_friendly_names)
+                .sort_values(list(col_friendly_names.values())))
 
-        df = cysh.get_object_df(
-            'Intervention_Session__c',
-            ['Id', 'Comments__c'],
-            rename_id=True
-        )
-        df = df.loc[df['Comments__c'].str.contains(all_typos)==True]
+        return df[list(col_friendly_names.values())]
 
-        df['Comments__c_fixed'] = df['Comments__c']
-        for k, v in typo_map.items():
-            df.loc[:, 'Comments__c_fixed'] = \
-                df['Comments__c_fixed'].replace(regex=v, value=k)
+    @staticmethod
+    def _get_incremental_errors_df(rebuild=False):
+        """ Returns evaluated session results that have errors, re-evaluating
+        only those changed since the stored watermark. Everything is
+        re-evaluated if the rules or any of `LOOKUP_OBJECTS` changed.
+        """
+        rules = ERROR_RULES + load_error_rules()
+        rules_hash = _rules_hash(rules)
+
+        # Taken before querying, so changes made while this run is in
+        # progress are picked up by the next one
+        watermark = datetime.now(timezone.utc)
+        lookup_watermarks = _lookup_watermarks()
+
+        state = None
+        if AUDIT_STATE_PATH.exists() and not rebuild:
+            state = pd.read_pickle(AUDIT_STATE_PATH)
+            if state['watermark'].tzinfo is None:
+                state['watermark'] = state['watermark'].replace(
+                    tzinfo=timezone.utc)
+
+            changed = [name for name, value in lookup_watermarks.items()
+                       if state.get('lookup_watermarks', {}).get(name)
+                       != value]
+            if watermark - state['watermark'] > MAX_INCREMENTAL_AGE:
+                logging.info('ToT audit state is too old to update '
+                             'incrementally, rebuilding')
+                state = None
+            elif state.get('rules_hash') != rules_hash:
+                logging.info('ToT audit rules changed, rebuilding')
+                state = None
+            elif changed:
+                logging.info(f"{', '.join(changed)} changed since the last "
+                             'ToT audit, rebuilding')
+                state = None
+
+        if state is None:
+            logging.info('Evaluating all session results for ToT audit')
+            df = ToTAudit._get_session_results_df()
+            errors_df = df.iloc[0:0]
+            stale_ids = set()
+        else:
+            since = state['watermark'].strftime('%Y-%m-%dT%H:%M:%SZ')
+            df = ToTAudit._get_session_results_df(where=(
+                f"SystemModstamp > {since} OR "
+                f"Intervention_Session__r.SystemModstamp > {since}"
+            ))
+            deleted = cysh.sf.Intervention_Session_Result__c.deleted(
+                state['watermark'], watermark
+            )
+            errors_df = state['errors_df']
+            stale_ids = (set(df['Id']) |
+                         {r['id'] for r in deleted['deletedRecords']})
+            logging.info(f'Re-evaluating {len(df)} changed session results '
+                         'for ToT audit')
 
-        return df
+        df['Error'] = evaluate_error_rules(df, rules)
+
+        errors_df = pd.concat([
+            errors_df.loc[~errors_df['Id'].isin(stale_ids)],
+            df.loc[df['Error'] != '']
+        ], ignore_index=True)
+
+        pd.to_pickle({'watermark': watermark, 'errors_df': errors_df,
+                      'lookup_watermarks': lookup_watermarks,
+                      'rules_hash': rules_hash},
+                     AUDIT_STATE_PATH)
+
+        return errors_df
 
     @staticmethod
-    def get_errors_df():
+    def _get_session_results_df(where=None):
+        """ Returns session results merged with their session, section,
+        school, staff and program. `where` filters the session results.
+        """
         ISR_df = cysh.get_object_df(
             'Intervention_Session_Result__c',
-            ['Amount_of_Time__c', 'IsDeleted', 'Intervention_Session_Date__c',
-             'Related_Student_s_Name__c', 'Intervention_Session__c',
-             'CreatedDate']
-        )
-        IS_df = cysh.get_object_df(
-            'Intervention_Session__c',
-            ['Id', 'Name', 'Comments__c', 'Section__c'],
-            rename_id=True, rename_name=True
+            ['Id', 'Amount_of_Time__c', 'IsDeleted',
+             'Intervention_Session_Date__c', 'Related_Student_s_Name__c',
+             'Intervention_Session__c', 'CreatedDate'],
+            where=where
         )
+        IS_cols = ['Id', 'Name', 'Comments__c', 'Section__c']
+        if where:
+            IS_df = cysh.get_object_df_in(
+                'Intervention_Session__c', IS_cols, 'Id',
+                ISR_df['Intervention_Session__c'].dropna().unique(),
+                rename_id=True, rename_name=True
+            )
+        else:
+            IS_df = cysh.get_object_df(
+                'Intervention_Session__c', IS_cols,
+                rename_id=True, rename_name=True
+            )
+
+        # Lowercase tier codes are left out of the typo pre-filter, so they
+        # are fixed in these sessions before the audit reads them
+        fixes_df = ToTAudit.get_T1T2ELT_typo_fixes_df(IS_df)
+        write_typo_fixes(fixes_df)
+        IS_df.loc[fixes_df.index, 'Comments__c'] = \
+            fixes_df['Comments__c_fixed']
         section_df = cysh.get_object_df(
             'Section__c',
             ['Id', 'School__c', 'Intervention_Primary_Staff__c', 'Program__c'],
@@ -156,69 +390,131 @@ class ToTAudit:
         df['CreatedDate'] = pd.to_datetime(df['CreatedDate']).dt.date
         df['Comments__c'] = df['Comments__c'].fillna('')
 
-        error_masks = {
-            'Missing T1/T2 Code': (
-                df['Program__c_Name'].str.contains('Tutoring')
-                & ~df['Comments__c'].str.contains('T1|T2')
-            ),
-            'Listed T1 and T2': (
-                df['Program__c_Name'].str.contains('Tutoring')
-                & df['Comments__c'].str.contains('T1')
-                & df['Comments__c'].str.contains('T2')
-            ),
-            '<10 Minutes': (
-                df['Program__c_Name'].isin([
-                    'SEL Check In Check Out',
-                    'Coaching: Attendance',
-                    'Tutoring: Math',
-                    'Tutoring: Literacy'
-                ])
-                & (df['Amount_of_Time__c'] < 10)
-            ),
-            '>120 Minutes': (
-                df['Program__c_Name'].str.contains('Tutoring')
-                & (df['Amount_of_Time__c'] > 120)
-            ),
-            'Logged in Future': (
-                df['Intervention_Session_Date__c'] > df['CreatedDate']
-            ),
-            'Wrong Section': (
-                df['Program__c_Name'].isin(['DESSA', 'Math Inventory',
-                                            'Reading Inventory'])
-            ),
-        }
-
-        for error_name, mask in error_masks.items():
-            df.loc[mask, error_name] = error_name
-
-        error_cols = list(error_masks.keys())
-
-        df['Error'] = \
-            df[error_cols].apply(lambda x: x.str.cat(sep=' & '), axis=1)
-
-        accepted_errors_df = pd.read_excel((
-            f"Z:/ChiPrivate/Chicago Data and Evaluation/{YEAR}/"
-            f"{YEAR} ToT Audit Accepted Errors.xlsx"
-        ))
-
-        df = df.loc[(df['Error'] != '') &
-                    ~df['Intervention_Session__c_Name'].isin(
-                        accepted_errors_df['SESSION_ID'])]
-
-        col_friendly_names = {
-            'School_Name__c':'School',
-            'Staff__c_Name':'ACM',
-            'Program__c_Name':'Program',
-            'Intervention_Session__c_Name':'Session ID',
-            'Related_Student_s_Name__c':'Student',
-            'CreatedDate':'Submission Date',
-            'Intervention_Session_Date__c':'Session Date',
-            'Amount_of_Time__c':'ToT',
-            #'Comments__c':'Comment',
-            'Error':'Error',
-        }
+        return df
 
-        df = (df.rename(columns=col_friendly_names)
-                .sort_values(list(col_friendly_names.values())))
 
-        return df[list(col_friendly_names.values())]
+def write_typo_fixes(df):
+    """ Writes the fixed comments of `get_T1T2ELT_typo_fixes_df` rows back to
+    their sessions. Returns a report with one row per session, or None.
+    """
+    if df.empty:
+        return None
+
+    logging.info(f"Fixing {len(df)} T1, T2, or ELT typos")
+
+    report = cysh.update_records(
+        'Intervention_Session__c',
+        df[['Intervention_Session__c', 'Comments__c_fixed']]
+          .rename(columns={'Intervention_Session__c': 'Id',
+                           'Comments__c_fixed': 'Comments__c'})
+    )
+
+    for _, row in report.loc[~report['success']].iterrows():
+        logging.warning(f'T1, T2, ELT fix failed for {row.Id}: '
+                        f'{row.errors}')
+
+    return report
+
+
+def _stage_and_publish(df, staged_path, write_path):
+    write_xlsx(df, staged_path)
+    publish_file(staged_path, write_path)
+
+
+def load_error_rules(path=SITE_RULES_PATH):
+    """ Loads site-specific audit rules from a spreadsheet with one row per
+    rule and a column per condition in `ERROR_RULES`. List conditions
+    (`program_in`, `comments_match`) are separated by semicolons.
+    """
+    path = Path(path)
+    if not path.exists():
+        return []
+
+    rules = []
+    for _, row in pd.read_excel(path).iterrows():
+        rule = row.dropna().to_dict()
+        for key in ['program_in', 'comments_match']:
+            if key in rule:
+                rule[key] = [x.strip() for x in str(rule[key]).split(';')]
+        rules.append(rule)
+
+    return rules
+
+
+def _lookup_watermarks():
+    """ Returns the latest SystemModstamp and record count of each of
+    `LOOKUP_OBJECTS`; the count catches deletions.
+    """
+    watermarks = {}
+    for object_name in LOOKUP_OBJECTS:
+        record = cysh.execute_query(
+            "SELECT MAX(SystemModstamp) modstamp, COUNT(Id) n "
+            f"FROM {object_name}"
+        )['records'][0]
+        watermarks[object_name] = (record['modstamp'], record['n'])
+    return watermarks
+
+
+def _rules_hash(rules):
+    text = json.dumps(rules, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def evaluate_error_rules(df, rules=ERROR_RULES):
+    """ Returns a Series naming the rules each row breaks, joined by ' & ', or
+    '' for rows without errors.
+
+    Every rule sets one bit of a per-row error code. Text conditions are
+    evaluated once per distinct program name or comment, and codes are decoded
+    to labels through a lookup table built from the codes that occur.
+    """
+    if len(rules) > 63:
+        raise ValueError('At most 63 audit rules are supported')
+
+    text = {
+        'program': pd.factorize(df['Program__c_Name'].fillna('')),
+        'comments': pd.factorize(df['Comments__c'].fillna('')),
+    }
+    minutes = df['Amount_of_Time__c'].to_numpy(dtype=float)
+    masks = {}
+
+    def text_mask(column, pattern):
+        key = (column, pattern)
+        if key not in masks:
+            codes, uniques = text[column]
+            regex = re.compile(pattern)
+            hits = np.fromiter((regex.search(u) is not None for u in uniques),
+                               dtype=bool, count=len(uniques))
+            masks[key] = hits[codes]
+        return masks[key]
+
+    error_codes = np.zeros(len(df), dtype=np.int64)
+    for bit, rule in enumerate(rules):
+        mask = np.ones(len(df), dtype=bool)
+
+        if 'program_contains' in rule:
+            mask &= text_mask('program', rule['program_contains'])
+        if 'program_in' in rule:
+            names = '|'.join(map(re.escape, rule['program_in']))
+            mask &= text_mask('program', f'^(?:{names})$')
+        for pattern in rule.get('comments_match', []):
+            mask &= text_mask('comments', pattern)
+        if 'comments_lack' in rule:
+            mask &= ~text_mask('comments', rule['comments_lack'])
+        if 'min_minutes' in rule:
+            mask &= minutes < rule['min_minutes']
+        if 'max_minutes' in rule:
+            mask &= minutes > rule['max_minutes']
+        if rule.get('session_after_submission'):
+            mask &= (df['Intervention_Session_Date__c'] >
+                     df['CreatedDate']).to_numpy(dtype=bool)
+
+        error_codes |= mask.astype(np.int64) << bit
+
+    labels = {
+        code: ' & '.join(rule['name'] for bit, rule in enumerate(rules)
+                         if code >> bit & 1)
+        for code in np.unique(error_codes)
+    }
+
+    return pd.Series(error_codes, index=df.index).map(labels)
@@ -1,13 +1,53 @@
+import hashlib
 import logging
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import copy
+from io import BytesIO
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from xml.etree import ElementTree
 
+import openpyxl
 import pandas as pd
-import xlwings as xw
+from openpyxl.utils import get_column_letter
+from openpyxl.workbook.defined_name import DefinedName
 from PyPDF2 import PdfFileMerger
 
 from . import simple_cysh as cysh
 from .config import EXCEL_PROTECTION_PWD, TEMP_PATH, TEMPLATES_PATH, YEAR
-from .utils import get_sch_ref_df
+from .service_tracker_pdf import render_acm_pdf
+from .utils import df_hash, get_sch_ref_df, publish_file
+
+
+# Columns of the coaching log 'ACM Rollup' sheet
+ROLLUP_HEADERS = [
+    'Individual__c', 'ACM', 'Date', 'Role', 'Virtual or In Person',
+    'Coaching Cycle', 'Subject', 'Focus', 'Strategy/Skill', 'Notes',
+    'Action Steps', 'Completed?', 'Followed Up'
+]
+# Block of each ACM sheet that feeds the rollup, after the name in A1
+ROLLUP_SOURCE_RANGE = 'A3:K302'
+ROLLUP_ID_FORMULA = ("=INDEX('ACM Validation'!$A:$A, "
+                     "MATCH($B{row}, 'ACM Validation'!$C:$C, 0))")
+# Coaching log sheets that are not ACM logs
+ROLLUP_SKIP_SHEETS = set(
+    ['Dev Tracker', 'Dev Map', 'ACM Template', 'ACM Validation',
+     'ACM Rollup', 'Calendar Validation', 'Log Validation'] +
+    [f'Sheet{_}' for _ in range(1,9)]
+)
+
+
+# Hidden defined name holding a hash of a tracker's validation data
+FINGERPRINT_NAME = 'CYSH_VALIDATION_FINGERPRINT'
+XLSX_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+# Staff listed on 'ACM Validation' sheets
+VALIDATION_ROLES = ['Corps Member', 'Second Year Corps Member',
+                    'Senior Corps Team Leader']
+# Grades listed on 'Student Validation' sheets, by school type
+HIGH_SCHOOL_GRADES = ['9', '10']
+K8_GRADES = ['k'] + [str(i) for i in range(1, 9)]
 
 
 class Tracker:  # class used only for inheritance
@@ -32,21 +72,75 @@ class Tracker:  # class used only for inheritance
             axis=1
         )
         self.sch_ref_df = self.sch_ref_df.set_index('Informal Name')
+        self._prefetched = None
+
+    def prefetch(self, students=True):
+        """ Loads validation staff and students for every school in
+        `sch_ref_df` with one query per object, and keeps them partitioned
+        by school for the per-school writers. Call again to refresh.
+        """
+        schools = self.sch_ref_df['School'].tolist()
+
+        staff_df = cysh.get_staff_df(schools=schools, roles=VALIDATION_ROLES)
+        self._prefetched = {
+            'staff': dict(tuple(staff_df.groupby('School'))),
+            'staff_empty': staff_df.iloc[0:0],
+        }
+
+        if students:
+            grade_levels = sorted(set(HIGH_SCHOOL_GRADES + K8_GRADES))
+            stdnt_df = cysh.get_object_df(
+                'Student__c',
+                ['Name', 'Id', 'School_Name__c', 'Grade__c'],
+                where=(f"School_Name__c IN {cysh.in_str(schools)} "
+                       f"AND Grade__c IN {cysh.in_str(grade_levels)}")
+            )
+            # Match SOQL, whose IN and ORDER BY ignore case
+            stdnt_df = stdnt_df.sort_values('Name', kind='mergesort',
+                                            key=lambda s: s.str.lower())
+            self._prefetched['students'] = dict(tuple(
+                stdnt_df.groupby(stdnt_df['School_Name__c'].str.lower())
+            ))
+            self._prefetched['students_empty'] = stdnt_df.iloc[0:0]
+
+        logging.info(f'Prefetched validation data for {len(schools)} schools')
+
+    def _grade_levels(self, school_informal):
+        if self.sch_ref_df.loc[school_informal, 'GradeLevel'] == 'High':
+            return HIGH_SCHOOL_GRADES
+        return K8_GRADES
 
 
 class ExcelTracker(Tracker):  # class used only for inheritance
+    has_student_validation = False
+    # Extra keyword arguments for `_edit_validation_xlsx`
+    _edit_options = {}
+
     def __init__(self, kind, folder, filetype, test):
         super().__init__(kind=kind, folder=folder, filetype=filetype,
                          test=test)
 
-    def deploy_all(self):
+    def deploy_all(self, backend='excel', max_workers=None):
         """ Distributes tracker for all school teams. Run only at the
         start of the year.
+
+        backend: 'excel' fills a freshly opened template per school in Excel.
+                 'openpyxl' reads the template once, then copies its bytes
+                 and edits the title and validation sheets of each copy
+                 across a process pool (see
+                 `update_all_acm_stdnt_validation_sheets` for its limits).
         """
         resp = input(f'This will overwrite {self.kind}s. Are you sure? y/n: ')
         if resp.lower() != 'y':
             return None
 
+        self.prefetch(students=self.has_student_validation)
+
+        if backend == 'openpyxl':
+            self._deploy_all_xlsx(max_workers)
+            return None
+
+        import xlwings as xw
         app = xw.App()
         for school_informal in self.sch_ref_df.index:
             wb = app.books.open(self.template_path)
@@ -54,6 +148,35 @@ class ExcelTracker(Tracker):  # class used only for inheritance
 
         app.kill()
 
+    def _deploy_all_xlsx(self, max_workers=None):
+        template_bytes = Path(self.template_path).read_bytes()
+
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {}
+            for school_informal, write_path in \
+                    self.sch_ref_df['tracker_path'].items():
+                data = self._get_validation_data(school_informal)
+                if self.test:
+                    write_path.parent.mkdir(parents=True, exist_ok=True)
+
+                future = pool.submit(
+                    clone_template_xlsx, template_bytes, write_path,
+                    self._edit_validation_xlsx, data,
+                    validation_fingerprint(data), title=write_path.stem,
+                    **self._edit_options
+                )
+                futures[future] = write_path
+
+            for future in as_completed(futures):
+                write_path = futures[future]
+                try:
+                    future.result()
+                    logging.info(f"Deployed {write_path.stem}")
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception:
+                    logging.exception(f"Failed to deploy {write_path.stem}")
+
     def deploy_one(self, school_informal, wb=None, warn=True):
         """ Distributes tracker for just one school team.
 
@@ -61,6 +184,8 @@ class ExcelTracker(Tracker):  # class used only for inheritance
                          school reference dataframe
         wb: optional template workbook (loads automatically by default)
         """
+        import xlwings as xw
+
         if warn:
             resp = input(f'This will overwrite {self.kind}s. '
                           'Are you sure? y/n: ')
@@ -87,6 +212,9 @@ class ExcelTracker(Tracker):  # class used only for inheritance
             self.update_one_stdnt_validation_sheet(school_informal, wb,
                                                    save_and_close=False)
 
+        data = self._get_validation_data(school_informal)
+        write_fingerprint(wb, validation_fingerprint(data))
+
         if self.test:
             write_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -94,6 +222,8 @@ class ExcelTracker(Tracker):  # class used only for inheritance
 
     def update_one_acm_validation_sheet(self, school_informal: str, wb=None,
                                         save_and_close=True):
+        import xlwings as xw
+
         if not wb:
             wb_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
             wb = xw.Book(wb_path)
@@ -114,39 +244,144 @@ class ExcelTracker(Tracker):  # class used only for inheritance
                                           save_and_close=True):
         pass
 
-    def update_all_acm_stdnt_validation_sheets(self):
+    def update_all_acm_stdnt_validation_sheets(self, backend='excel',
+                                               max_workers=None):
         """ Iterates through trackers and updates the ACM and Student names for
-        dropdown validations.
+        dropdown validations. Trackers whose stored fingerprint matches the
+        current validation data are skipped without being opened.
+
+        backend: 'excel' edits each workbook in a live Excel process.
+                 'openpyxl' edits the xlsx files directly, across a process
+                 pool, and does not need Excel. It does not keep
+                 images or charts, so use it only for trackers without them.
+
+        Returns a DataFrame with the status of each school's tracker.
         """
+        self.prefetch(students=self.has_student_validation)
+
+        status = {}
+        jobs = {}
+        for school_informal, row in self.sch_ref_df.iterrows():
+            data = self._get_validation_data(school_informal)
+            fingerprint = validation_fingerprint(data)
+            if read_fingerprint(row['tracker_path']) == fingerprint:
+                status[school_informal] = 'skipped'
+            else:
+                jobs[school_informal] = (data, fingerprint)
+
+        skipped = [k for k, v in status.items() if v == 'skipped']
+        logging.info(f"Skipping {len(skipped)} unchanged {self.kind}s: "
+                     f"{', '.join(skipped)}")
+
+        if backend == 'openpyxl':
+            status.update(self._update_all_validation_xlsx(jobs, max_workers))
+        else:
+            status.update(self._update_all_validation_excel(jobs))
+
+        return (pd.Series(status, name='Status')
+                  .rename_axis('Informal Name')
+                  .reset_index())
+
+    def _update_all_validation_excel(self, jobs):
+        import xlwings as xw
+
+        status = {}
         app = xw.App()
         # app.display_alerts = False
-        for school_informal, row in self.sch_ref_df.iterrows():
-            wb_path = row['tracker_path']
+        for school_informal, (_, fingerprint) in jobs.items():
+            wb_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
             logging.info(f'Updating {wb_path.stem}')
 
-            wb = app.books.open(wb_path)
-            wb.api.Unprotect(EXCEL_PROTECTION_PWD)
+            try:
+                wb = app.books.open(wb_path)
+                wb.api.Unprotect(EXCEL_PROTECTION_PWD)
 
-            sheet_names = [x.name for x in wb.sheets]
+                sheet_names = [x.name for x in wb.sheets]
 
-            if 'ACM Validation' in sheet_names:
-                self.update_one_acm_validation_sheet(
-                    school_informal, wb, save_and_close=False)
+                if 'ACM Validation' in sheet_names:
+                    self.update_one_acm_validation_sheet(
+                        school_informal, wb, save_and_close=False)
 
-            if 'Student Validation' in sheet_names:
-                self.update_one_stdnt_validation_sheet(
-                    school_informal, wb, save_and_close=False)
+                if 'Student Validation' in sheet_names:
+                    self.update_one_stdnt_validation_sheet(
+                        school_informal, wb, save_and_close=False)
 
-            wb_save_and_close(wb)
+                write_fingerprint(wb, fingerprint)
+                wb_save_and_close(wb, wb_path)
+                status[school_informal] = 'updated'
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception:
+                logging.exception(f'Failed to update {wb_path.stem}')
+                status[school_informal] = 'failed'
 
         app.kill()
 
+        return status
+
+    def _update_all_validation_xlsx(self, jobs, max_workers=None):
+        # Queries have already run; only file edits are sent to the pool
+        status = {}
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {}
+            for school_informal, (data, fingerprint) in jobs.items():
+                wb_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
+                future = pool.submit(self._edit_validation_xlsx, wb_path,
+                                     data, fingerprint, **self._edit_options)
+                futures[future] = school_informal
+
+            for future in as_completed(futures):
+                school_informal = futures[future]
+                try:
+                    future.result()
+                    logging.info(f'Updated {self.kind} for {school_informal}')
+                    status[school_informal] = 'updated'
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception:
+                    logging.exception(f'Failed to update {self.kind} for '
+                                      f'{school_informal}')
+                    status[school_informal] = 'failed'
+
+        return status
+
+    def _get_validation_data(self, school_informal):
+        """ Returns {sheet name: DataFrame} of the validation lists for one
+        school.
+        """
+        data = {'ACM Validation': self._get_staff_df(school_informal)}
+
+        stdnt_df = self._get_stdnt_df(school_informal)
+        if stdnt_df is not None:
+            data['Student Validation'] = stdnt_df
+
+        return data
+
+    @staticmethod
+    def _edit_validation_xlsx(wb_path, data, fingerprint=None, title=None):
+        wb = openpyxl.load_workbook(wb_path)
+        if title:
+            wb.worksheets[0]['A1'].value = title
+        for sheet_name, df in data.items():
+            if sheet_name in wb.sheetnames:
+                write_validation_sheet_xlsx(wb[sheet_name], df)
+        if fingerprint:
+            write_fingerprint_xlsx(wb, fingerprint)
+        wb.active = 0
+        wb.save(wb_path)
+
+    def _get_stdnt_df(self, school_informal):
+        return None
+
     def _get_staff_df(self, school_informal):
         school_formal = self.sch_ref_df.loc[school_informal, 'School']
 
-        roles = ['Corps Member', 'Second Year Corps Member',
-                 'Senior Corps Team Leader']
-        staff_df = cysh.get_staff_df(schools=[school_formal], roles=roles)
+        if self._prefetched:
+            staff_df = self._prefetched['staff'].get(
+                school_formal, self._prefetched['staff_empty']).copy()
+        else:
+            staff_df = cysh.get_staff_df(schools=[school_formal],
+                                         roles=VALIDATION_ROLES)
 
         staff_df['First_Name_Staff__c'] = (
             staff_df['First_Name_Staff__c'] + " " +
@@ -162,6 +397,8 @@ class ExcelTracker(Tracker):  # class used only for inheritance
 
 
 class AttendanceTracker(ExcelTracker):
+    has_student_validation = True
+
     def __init__(self, test=False):
         super().__init__(
             kind='Attendance Tracker',
@@ -172,17 +409,34 @@ class AttendanceTracker(ExcelTracker):
 
     def update_one_stdnt_validation_sheet(self, school_informal: str, wb=None,
                                           save_and_close=True):
+        import xlwings as xw
+
         if not wb:
             wb_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
             wb = xw.Book(wb_path)
 
+        stdnt_df = self._get_stdnt_df(school_informal)
+
+        sht = wb.sheets['Student Validation']
+        sht.api.Unprotect(EXCEL_PROTECTION_PWD)
+        sht.clear_contents()
+        sht.range('A1').options(index=False, header=False).value = stdnt_df
+        sht.api.Protect(EXCEL_PROTECTION_PWD)
+        sht.api.Visible = False
+
+        if save_and_close:
+            wb_save_and_close(wb)
+
+    def _get_stdnt_df(self, school_informal):
         school_formal = self.sch_ref_df.loc[school_informal, 'School']
-        school_type = self.sch_ref_df.loc[school_informal, 'GradeLevel']
+        grade_levels = self._grade_levels(school_informal)
 
-        if school_type == 'High':
-            grade_levels = ['9', '10']
-        else:
-            grade_levels = ['k'] + [str(i) for i in range(1, 9)]
+        if self._prefetched and 'students' in self._prefetched:
+            stdnt_df = self._prefetched['students'].get(
+                school_formal.lower(), self._prefetched['students_empty'])
+            stdnt_df = stdnt_df.loc[stdnt_df['Grade__c'].str.lower().isin(
+                [g.lower() for g in grade_levels])]
+            return stdnt_df[['Name', 'Id']]
 
         stdnt_df = cysh.soql_query_as_df(
             """
@@ -197,15 +451,7 @@ class AttendanceTracker(ExcelTracker):
             )
         )
 
-        sht = wb.sheets['Student Validation']
-        sht.api.Unprotect(EXCEL_PROTECTION_PWD)
-        sht.clear_contents()
-        sht.range('A1').options(index=False, header=False).value = stdnt_df
-        sht.api.Protect(EXCEL_PROTECTION_PWD)
-        sht.api.Visible = False
-
-        if save_and_close:
-            wb_save_and_close(wb)
+        return stdnt_df
 
 
 class LeadershipTracker(ExcelTracker):
@@ -219,16 +465,27 @@ class LeadershipTracker(ExcelTracker):
 
 
 class CoachingLog(ExcelTracker):
-    def __init__(self, test=False):
+    def __init__(self, test=False, rollup_mode='formulas'):
+        """
+        rollup_mode: 'formulas' writes live cross-sheet formulas to the
+                     'ACM Rollup' sheet. 'values' writes static values
+                     computed from the ACM sheets, which keeps the workbook
+                     light but is only as fresh as the last update or
+                     `refresh_rollups`.
+        """
         super().__init__(
             kind='Coaching Log',
             folder='Leadership Team Documents',
             filetype='.xlsx',
             test=test
         )
+        self.rollup_mode = rollup_mode
+        self._edit_options = {'rollup_mode': rollup_mode}
 
     def update_one_acm_validation_sheet(self, school_informal: str, wb=None,
                                         save_and_close=True):
+        import xlwings as xw
+
         if not wb:
             wb_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
             wb = xw.Book(wb_path)
@@ -254,37 +511,73 @@ class CoachingLog(ExcelTracker):
                 acm_sheet.range('A1').value = r['Staff__c_Name']
                 acm_sheet.api.Visible = True
 
-        self._fill_acm_rollup_sheet(wb)
+        self._fill_acm_rollup_sheet(wb, self.rollup_mode)
 
         if save_and_close:
             wb_save_and_close(wb, wb_path)
 
+    def refresh_rollups(self, backend='excel', max_workers=None):
+        """ Rewrites the 'ACM Rollup' sheet of every coaching log from its
+        ACM sheets. No Salesforce queries are made.
+        """
+        paths = self.sch_ref_df['tracker_path']
+
+        if backend == 'openpyxl':
+            with ProcessPoolExecutor(max_workers) as pool:
+                futures = {
+                    pool.submit(self._refresh_rollup_xlsx, wb_path,
+                                self.rollup_mode): wb_path
+                    for wb_path in paths
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except (KeyboardInterrupt, SystemExit):
+                        raise
+                    except Exception:
+                        logging.exception('Failed to refresh rollup for '
+                                          f'{futures[future].stem}')
+            return None
+
+        import xlwings as xw
+        app = xw.App()
+        for wb_path in paths:
+            logging.info(f'Refreshing rollup for {wb_path.stem}')
+            wb = app.books.open(wb_path)
+            wb.api.Unprotect(EXCEL_PROTECTION_PWD)
+            self._fill_acm_rollup_sheet(wb, self.rollup_mode)
+            wb_save_and_close(wb, wb_path)
+        app.kill()
+
     @staticmethod
-    def _fill_acm_rollup_sheet(wb):
+    def _fill_acm_rollup_sheet(wb, rollup_mode='formulas'):
         sht = wb.sheets['ACM Rollup']
         sht.clear_contents()
 
         # fill headers
-        headers = [
-            'Individual__c', 'ACM', 'Date', 'Role', 'Virtual or In Person',
-            'Coaching Cycle', 'Subject', 'Focus', 'Strategy/Skill', 'Notes',
-            'Action Steps', 'Completed?', 'Followed Up'
-        ]
+        headers = ROLLUP_HEADERS
         sht.range('A1').value = headers
 
+        acm_sheets = [x.name for x in wb.sheets
+                      if x.name not in ROLLUP_SKIP_SHEETS]
+
+        if rollup_mode == 'values':
+            validation = (wb.sheets['ACM Validation'].used_range
+                            .options(ndim=2).value)
+            rows = acm_rollup_rows(
+                validation,
+                ((wb.sheets[x].range('A1').value,
+                  wb.sheets[x].range(ROLLUP_SOURCE_RANGE).value)
+                 for x in acm_sheets)
+            )
+            if rows:
+                sht.range('A2').value = rows
+            sht.api.Visible = False
+            return None
+
         # fill column A
-        sht.range('A2:A3002').value = (
-            "=INDEX('ACM Validation'!$A:$A, "
-            "MATCH($B2, 'ACM Validation'!$C:$C, 0))"
-        )
+        sht.range('A2:A3002').value = ROLLUP_ID_FORMULA.format(row=2)
         # fill columns B:-1
-        skip_sheets = set(
-            ['Dev Tracker', 'Dev Map', 'ACM Template', 'ACM Validation',
-             'ACM Rollup', 'Calendar Validation', 'Log Validation'] +
-            [f'Sheet{_}' for _ in range(1,9)]
-        )
-        acm_sheets = [x.name for x in wb.sheets if x.name not in skip_sheets]
-
         last_col = chr(64 + len(headers))
 
         row = 2
@@ -296,6 +589,118 @@ class CoachingLog(ExcelTracker):
 
         sht.api.Visible = False
 
+    @staticmethod
+    def _edit_validation_xlsx(wb_path, data, fingerprint=None, title=None,
+                              rollup_mode='formulas'):
+        """ openpyxl version of `update_one_acm_validation_sheet`
+        """
+        staff_df = data['ACM Validation']
+        wb = openpyxl.load_workbook(wb_path)
+        if title:
+            wb.worksheets[0]['A1'].value = title
+
+        write_validation_sheet_xlsx(wb['ACM Validation'], staff_df,
+                                    protect=False)
+
+        template = wb['ACM Template']
+        template['A1'].value = None
+        for row in template['A3:J300']:
+            for cell in row:
+                cell.value = None
+        template.sheet_state = 'hidden'
+
+        sheet_names_lower = [x.lower() for x in wb.sheetnames]
+
+        for _, r in staff_df.iterrows():
+            if r['First_Name_Staff__c'].lower() not in sheet_names_lower:
+                acm_sheet = copy_worksheet_xlsx(wb, template,
+                                                r['First_Name_Staff__c'],
+                                                before='Dev Map')
+                acm_sheet['A1'].value = r['Staff__c_Name']
+                acm_sheet.sheet_state = 'visible'
+
+        CoachingLog._fill_acm_rollup_sheet_xlsx(wb, rollup_mode, wb_path)
+
+        if fingerprint:
+            write_fingerprint_xlsx(wb, fingerprint)
+        wb.active = 0
+        wb.save(wb_path)
+
+    @staticmethod
+    def _refresh_rollup_xlsx(wb_path, rollup_mode='formulas'):
+        wb = openpyxl.load_workbook(wb_path)
+        CoachingLog._fill_acm_rollup_sheet_xlsx(wb, rollup_mode, wb_path)
+        wb.save(wb_path)
+
+    @staticmethod
+    def _fill_acm_rollup_sheet_xlsx(wb, rollup_mode='formulas', wb_path=None):
+        """ openpyxl version of `_fill_acm_rollup_sheet`. In 'values' mode
+        the ACM sheets are read from the saved file at `wb_path`, since
+        openpyxl cannot evaluate formulas itself.
+        """
+        sht = wb['ACM Rollup']
+        sht.delete_rows(1, sht.max_row)
+
+        sht.append(ROLLUP_HEADERS)
+
+        acm_sheets = [x for x in wb.sheetnames if x not in ROLLUP_SKIP_SHEETS]
+
+        if rollup_mode == 'values':
+            saved = openpyxl.load_workbook(wb_path, read_only=True,
+                                           data_only=True)
+            # ACM sheets added since the last save have no rows yet
+            rows = acm_rollup_rows(
+                wb['ACM Validation'].iter_rows(values_only=True),
+                ((wb[x]['A1'].value,
+                  saved[x].iter_rows(min_row=3, max_row=302, max_col=11,
+                                     values_only=True))
+                 for x in acm_sheets if x in saved.sheetnames)
+            )
+            saved.close()
+            for r in rows:
+                sht.append(r)
+            sht.sheet_state = 'hidden'
+            return None
+
+        for row in range(2, 3003):
+            sht.cell(row, 1).value = ROLLUP_ID_FORMULA.format(row=row)
+
+        row = 2
+        for sheet_name in acm_sheets:
+            sheet_name = sheet_name.replace("'", "''")
+            for offset in range(301):
+                sht.cell(row + offset, 2).value = f"='{sheet_name}'!$A$1"
+                for col in range(3, len(ROLLUP_HEADERS) + 1):
+                    src = f"{get_column_letter(col - 2)}{3 + offset}"
+                    sht.cell(row + offset, col).value = f"='{sheet_name}'!{src}"
+            row += 300
+
+        sht.sheet_state = 'hidden'
+
+
+def acm_rollup_rows(validation, acm_sheets):
+    """ Computes the 'ACM Rollup' rows that the formula rollup would show.
+
+    validation: rows of the 'ACM Validation' sheet (Individual__c in column
+                A, ACM name in column C)
+    acm_sheets: iterable of (ACM name, rows of `ROLLUP_SOURCE_RANGE`)
+    """
+    id_by_name = {}
+    for r in validation or []:
+        if r and len(r) > 2 and r[2] is not None:
+            id_by_name.setdefault(r[2], r[0])
+
+    rows = []
+    for acm_name, block in acm_sheets:
+        for r in block or []:
+            values = list(r)
+            if all(v is None or v == '' for v in values):
+                continue
+            rows.append([id_by_name.get(acm_name), acm_name] + values)
+
+    return rows
+
+
 class WeeklyServiceTracker(Tracker):
     def __init__(self, test=False):
         super().__init__(
@@ -305,17 +710,74 @@ class WeeklyServiceTracker(Tracker):
             test=test
         )
 
-    def deploy_all(self):
+    def deploy_all(self, renderer='excel', max_workers=None):
         """ Runs the entire Service Tracker publishing process
+
+        renderer: 'excel' fills the template in Excel and exports each page.
+                  'pdf' draws the pages with reportlab across a process pool,
+                  and does not need Excel.
         """
+        schools = self.sch_ref_df['School']
+        stu_sec_df = self.get_enrollment_df(list(schools))
+        by_school = dict(list(stu_sec_df.groupby('School__c')))
+
+        if renderer == 'pdf':
+            self._deploy_all_pdf(by_school, stu_sec_df.iloc[0:0], max_workers)
+            return None
+
+        import xlwings as xw
         app = xw.App()
-        for school_informal in self.sch_ref_df.index:
-            wb = app.books.open(self.template_path)
-            self.deploy_one(school_informal, wb)
+        wb = app.books.open(self.template_path)
+        for school_informal, school_formal in schools.items():
+            self.deploy_one(
+                school_informal, wb,
+                stu_sec_df=by_school.get(school_formal, stu_sec_df.iloc[0:0])
+            )
 
         app.kill()
 
-    def deploy_one(self, school_informal, wb=None):
+    def _deploy_all_pdf(self, by_school, empty_df, max_workers=None):
+        # Schools without enrollment still get a (blank) tracker, as they do
+        # from Excel
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {}
+            schools = self.sch_ref_df['School']
+            for school_informal, school_formal in schools.items():
+                stu_sec_df = by_school.get(school_formal, empty_df)
+                futures[school_informal] = [
+                    (acm_name, pool.submit(
+                        render_acm_pdf, *self._acm_pdf_job(acm_df, acm_name)
+                    ))
+                    for acm_name, acm_df in stu_sec_df.groupby('Staff__c_Name')
+                ]
+
+            for school_informal, acm_futures in futures.items():
+                write_path = self.sch_ref_df.loc[school_informal,
+                                                 'tracker_path']
+                logging.info(f"Deploying {write_path.stem}")
+
+                pdfs = {}
+                for acm_name, future in acm_futures:
+                    try:
+                        pdfs[acm_name] = BytesIO(future.result())
+                    except (KeyboardInterrupt, SystemExit):
+                        raise
+                    except Exception as e:
+                        logging.error(f"Failed for {acm_name}: {e}")
+
+                if not write_path.parent.exists() and self.test:
+                    write_path.parent.mkdir(parents=True)
+
+                self._merge_and_save_one_school_pdf(pdfs, write_path)
+
+    def deploy_one(self, school_informal, wb=None, stu_sec_df=None):
+        """ Publishes one school's Service Tracker.
+
+        stu_sec_df: this school's rows of `get_enrollment_df`, queried if not
+                    given
+        """
+        import xlwings as xw
+
         school_formal = self.sch_ref_df.loc[school_informal, 'School']
         write_path = self.sch_ref_df.loc[school_informal, 'tracker_path']
         logging.info(f"Deploying {write_path.stem}")
@@ -323,39 +785,46 @@ class WeeklyServiceTracker(Tracker):
         if not wb:
             wb = xw.Book(self.template_path)
 
-        stu_sec_df = cysh.get_student_section_staff_df(
-            sections_of_interest = ['Coaching: Attendance',
-                                    'SEL Check In Check Out',
-                                    'Tutoring: Literacy',
-                                    'Tutoring: Math'],
-            schools=school_formal
-        )
-        stu_sec_df = self._process_section_enrollment_table(stu_sec_df)
-
-        # Ensure `temp` folder is empty
-        for path in Path(TEMP_PATH).iterdir():
-            if path.is_dir():
-                rm_tree(path)
-            else:
-                path.unlink()
-
-        for acm_name, acm_df in stu_sec_df.groupby('Staff__c_Name'):
-            try:
-                self._fill_one_acm_wb(acm_df, acm_name, wb)
-                pdf_path = f"{TEMP_PATH}/{acm_name}.pdf"
-                wb.sheets['Service Tracker'].api.ExportAsFixedFormat(0, pdf_path)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except Exception as e:
-                logging.error(f"Failed for {acm_name}: {e}")
+        if stu_sec_df is None:
+            stu_sec_df = self.get_enrollment_df(school_formal)
+
+        # Exports go to a directory of this job's own, so other schools can
+        # be built at the same time
+        pdfs = {}
+        with TemporaryDirectory(dir=TEMP_PATH) as temp_dir:
+            for acm_name, acm_df in stu_sec_df.groupby('Staff__c_Name'):
+                try:
+                    self._fill_one_acm_wb(acm_df, acm_name, wb)
+                    pdf_path = Path(temp_dir) / f"{acm_name}.pdf"
+                    wb.sheets['Service Tracker'].api.ExportAsFixedFormat(
+                        0, str(pdf_path)
+                    )
+                    pdfs[acm_name] = BytesIO(pdf_path.read_bytes())
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception as e:
+                    logging.error(f"Failed for {acm_name}: {e}")
 
         if not write_path.parent.exists() and self.test:
             write_path.parent.mkdir(parents=True)
 
-        self._merge_and_save_one_school_pdf(school_informal, write_path)
+        self._merge_and_save_one_school_pdf(pdfs, write_path)
 
         return None
 
+    def get_enrollment_df(self, schools):
+        """ Returns the processed enrollment table for the given schools,
+        using the same handful of queries however many schools are passed.
+        """
+        stu_sec_df = cysh.get_student_section_staff_df(
+            sections_of_interest = ['Coaching: Attendance',
+                                    'SEL Check In Check Out',
+                                    'Tutoring: Literacy',
+                                    'Tutoring: Math'],
+            schools=schools
+        )
+        return self._process_section_enrollment_table(stu_sec_df)
+
     @staticmethod
     def _process_section_enrollment_table(df):
         # group by Student_Program__c, then sum ToT
@@ -386,18 +855,16 @@ class WeeklyServiceTracker(Tracker):
             'Student_Name__c',
         ])
 
-        df = df[['School_Reference_Id__c', 'Staff__c_Name', 'Program__c_Name',
-                 'Student_Name__c', 'Dosage_to_Write']]
+        df = df[['School__c', 'School_Reference_Id__c', 'Staff__c_Name',
+                 'Program__c_Name', 'Student_Name__c', 'Dosage_to_Write']]
 
         return df
 
     @staticmethod
-    def _fill_one_acm_wb(acm_df, acm_name, wb):
-        # Write header
-        sht = wb.sheets['Header']
-        sht.range('A1').options(index=False, header=False).value = acm_name
-
-        # Write Course Performance
+    def _split_acm_df(acm_df, acm_name):
+        """ Splits one ACM's enrollment into the rows of each tracker section:
+        (Course Performance, SEL, Attendance CICO)
+        """
         df_acm_CP = acm_df.loc[
             acm_df['Program__c_Name'].isin(['Math', 'ELA'])
         ].copy()
@@ -405,12 +872,6 @@ class WeeklyServiceTracker(Tracker):
         if len(df_acm_CP) > 12:
             logging.warning(f"More than 12 Math/ELA students for {acm_name}\n")
 
-        sht = wb.sheets['Course Performance']
-        sht.range('B4:C15').clear_contents()
-        sht.range('B4').options(index=False, header=False).value = \
-            df_acm_CP[['Student_Name__c', 'Dosage_to_Write']][0:12]
-
-        # Write SEL
         df_acm_SEL = acm_df.loc[
             acm_df['Program__c_Name'].str.contains("SEL")
         ].copy()
@@ -418,12 +879,6 @@ class WeeklyServiceTracker(Tracker):
         if len(df_acm_SEL) > 6:
             logging.warning(f"More than 6 SEL students for {acm_name}\n")
 
-        sht = wb.sheets['SEL']
-        sht.range('B5:B10').clear_contents()
-        sht.range('B5').options(index=False, header=False).value = \
-            df_acm_SEL['Student_Name__c'][0:6]
-
-        # Write Attendance
         df_acm_attendance = acm_df.loc[
             acm_df['Program__c_Name'].str.contains("Attendance")
         ].copy()
@@ -431,29 +886,161 @@ class WeeklyServiceTracker(Tracker):
         if len(df_acm_attendance['Student_Name__c']) > 6:
             logging.warning(f"More than 6 Attendance students for {acm_name}\n")
 
+        return (df_acm_CP[['Student_Name__c', 'Dosage_to_Write']][0:12],
+                df_acm_SEL['Student_Name__c'][0:6],
+                df_acm_attendance['Student_Name__c'][0:6])
+
+    @staticmethod
+    def _fill_one_acm_wb(acm_df, acm_name, wb):
+        # Write header
+        sht = wb.sheets['Header']
+        sht.range('A1').options(index=False, header=False).value = acm_name
+
+        df_acm_CP, sel_names, attendance_names = \
+            WeeklyServiceTracker._split_acm_df(acm_df, acm_name)
+
+        # Write Course Performance
+        sht = wb.sheets['Course Performance']
+        sht.range('B4:C15').clear_contents()
+        sht.range('B4').options(index=False, header=False).value = df_acm_CP
+
+        # Write SEL
+        sht = wb.sheets['SEL']
+        sht.range('B5:B10').clear_contents()
+        sht.range('B5').options(index=False, header=False).value = sel_names
+
+        # Write Attendance
         sht = wb.sheets['Attendance CICO']
         sht.range('B4:B6, F4:F6').clear_contents()
         sht.range('B4').options(index=False, header=False).value = \
-            df_acm_attendance['Student_Name__c'][0:3]
+            attendance_names[0:3]
         sht.range('F4').options(index=False, header=False).value = \
-            df_acm_attendance['Student_Name__c'][3:6]
+            attendance_names[3:6]
 
         return None
 
     @staticmethod
-    def _merge_and_save_one_school_pdf(school_informal_name, write_path):
-        # Merge team PDFs
+    def _acm_pdf_job(acm_df, acm_name):
+        """ Returns the arguments of `render_acm_pdf` for one ACM
+        """
+        df_acm_CP, sel_names, attendance_names = \
+            WeeklyServiceTracker._split_acm_df(acm_df, acm_name)
+
+        return (acm_name,
+                list(df_acm_CP.itertuples(index=False, name=None)),
+                list(sel_names),
+                list(attendance_names))
+
+    @staticmethod
+    def _merge_and_save_one_school_pdf(pdfs, write_path):
+        """ Merges {ACM name: PDF file or buffer} in ACM name order and
+        publishes the result to `write_path` in one step.
+        """
         merger = PdfFileMerger()
-        for filepath in Path(TEMP_PATH).iterdir():
-            if filepath.name.endswith('.pdf'):
-                merger.append(str(filepath))
+        for acm_name in sorted(pdfs):
+            merger.append(pdfs[acm_name])
 
-        merger.write(str(write_path))
-        merger.close()
+        with TemporaryDirectory(dir=TEMP_PATH) as temp_dir:
+            merged_path = Path(temp_dir) / write_path.name
+            merger.write(str(merged_path))
+            merger.close()
+            publish_file(merged_path, write_path)
 
         return None
 
 
+def clone_template_xlsx(template_bytes, write_path, edit, *args, **kwargs):
+    """ Writes a copy of a template's bytes, applies `edit(path, *args,
+    **kwargs)` to the copy and publishes it to `write_path`.
+    """
+    write_path = Path(write_path)
+    with TemporaryDirectory(dir=TEMP_PATH) as temp_dir:
+        staged_path = Path(temp_dir) / write_path.name
+        staged_path.write_bytes(template_bytes)
+        edit(staged_path, *args, **kwargs)
+        publish_file(staged_path, write_path)
+
+
+def validation_fingerprint(data):
+    """ Returns a hash of {sheet name: DataFrame} validation data.
+    """
+    return hashlib.sha256(''.join(
+        f'{sheet_name}:{df_hash(df)};'
+        for sheet_name, df in sorted(data.items())
+    ).encode('utf-8')).hexdigest()
+
+
+def read_fingerprint(wb_path):
+    """ Returns the validation fingerprint stored in a workbook, reading only
+    the workbook part of the xlsx package. None if there is none.
+    """
+    try:
+        with zipfile.ZipFile(wb_path) as package:
+            root = ElementTree.fromstring(package.read('xl/workbook.xml'))
+    except (FileNotFoundError, KeyError, zipfile.BadZipFile):
+        return None
+
+    for defined_name in root.iter(f'{{{XLSX_MAIN_NS}}}definedName'):
+        if defined_name.get('name') == FINGERPRINT_NAME:
+            return (defined_name.text or '').strip('="')
+
+    return None
+
+
+def write_fingerprint(wb, fingerprint):
+    """ Stores the validation fingerprint in a hidden defined name of an
+    xlwings workbook.
+    """
+    name = wb.names.add(FINGERPRINT_NAME, f'="{fingerprint}"')
+    name.api.Visible = False
+
+
+def write_fingerprint_xlsx(wb, fingerprint):
+    """ openpyxl version of `write_fingerprint`
+    """
+    wb.defined_names[FINGERPRINT_NAME] = DefinedName(
+        FINGERPRINT_NAME, attr_text=f'"{fingerprint}"', hidden=True
+    )
+
+
+def write_validation_sheet_xlsx(ws, df, protect=True):
+    """ Replaces the values of an openpyxl worksheet with `df` (no header),
+    keeping cell formatting, then protects and hides the sheet.
+    """
+    for row in ws.iter_rows():
+        for cell in row:
+            cell.value = None
+
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        for j, value in enumerate(row, start=1):
+            ws.cell(i, j).value = None if pd.isna(value) else value
+
+    if protect:
+        ws.protection.set_password(EXCEL_PROTECTION_PWD)
+        ws.protection.enable()
+    ws.sheet_state = 'hidden'
+
+
+def copy_worksheet_xlsx(wb, ws, title, before):
+    """ Copies an openpyxl worksheet, including the data validations and
+    conditional formats that `copy_worksheet` drops, and places the copy
+    before the sheet named `before`.
+    """
+    new_ws = wb.copy_worksheet(ws)
+    new_ws.title = title
+
+    for dv in ws.data_validations.dataValidation:
+        new_ws.add_data_validation(copy(dv))
+    for cf in ws.conditional_formatting:
+        for rule in cf.rules:
+            new_ws.conditional_formatting.add(str(cf.sqref), rule)
+
+    wb.move_sheet(new_ws, wb.sheetnames.index(before) -
+                  wb.sheetnames.index(new_ws.title))
+
+    return new_ws
+
+
 def wb_save_and_close(wb, write_path=None):
     wb.sheets[0].activate()  # sets focus on first sheet of document
 
@@ -465,12 +1052,3 @@ def wb_save_and_close(wb, write_path=None):
         logging.exception(f"Failed to save {write_path.name}")
     finally:
         wb.close()
-
-
-def rm_tree(path: Path):
-    for child in path.glob('*'):
-        if child.is_file():
-            child.unlink()
-        else:
-            rm_tree(child)
-    path.rmdir()
@@ -1,13 +1,27 @@
 import datetime
+import hashlib
+import json
 import logging
 import os
+import shutil
 import subprocess
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
 
-from .config import SCH_REF_PATH
-
+import openpyxl
 import pandas as pd
 
+from .config import SCH_REF_PATH, STATE_PATH
+
+PUBLISH_MANIFEST_PATH = Path(STATE_PATH) / 'published.json'
+PUBLISH_MANIFEST_LOCK_PATH = Path(STATE_PATH) / 'published.json.lock'
+
+_manifest_lock = threading.Lock()
+
 
 def map_sharepoint_drive():
     try:
@@ -46,3 +60,93 @@ def get_sch_ref_df(sch_df_path=SCH_REF_PATH):
 
 def validate_date(date_str, date_fmt='%m/%d/%Y'):
     datetime.datetime.strptime(date_str, date_fmt)
+
+
+def df_hash(df):
+    """ Returns a hash of a DataFrame's columns and values.
+    """
+    return hashlib.sha256(df.to_csv(index=False).encode('utf-8')).hexdigest()
+
+
+def write_xlsx(df, path, title='Sheet1'):
+    """ Writes a DataFrame to a single-sheet workbook, streaming rows with
+    openpyxl's write-only mode rather than building the sheet in memory.
+    The sheet is named 'Sheet1' like `DataFrame.to_excel` names it.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title=title)
+    ws.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        ws.append([None if pd.isna(value) else value for value in row])
+    wb.save(path)
+
+
+def publish_file(src, dest):
+    """ Copies `src` next to `dest` and then renames it into place, so
+    readers of `dest` never see a partially written file.
+    """
+    dest = Path(dest)
+    partial = dest.with_name(dest.name + '.partial')
+    shutil.copyfile(src, partial)
+    os.replace(partial, dest)
+
+
+def load_publish_manifest():
+    """ Returns {path: content hash} of the files last published.
+    """
+    if PUBLISH_MANIFEST_PATH.exists():
+        return json.loads(PUBLISH_MANIFEST_PATH.read_text())
+    return {}
+
+
+def update_publish_manifest(entries):
+    """ Adds {path: content hash} entries to the manifest. The manifest is
+    re-read under a lock, so publishers running at the same time keep each
+    other's entries.
+    """
+    with publish_manifest_lock():
+        manifest = load_publish_manifest()
+        manifest.update(entries)
+        with NamedTemporaryFile('w', dir=PUBLISH_MANIFEST_PATH.parent,
+                                delete=False) as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f.name, PUBLISH_MANIFEST_PATH)
+
+
+@contextmanager
+def publish_manifest_lock(timeout=60, stale_after=300):
+    """ Holds a lock file shared by all processes that update the manifest.
+    A lock older than `stale_after` seconds is taken to be left by a process
+    that died, and is broken.
+    """
+    with _manifest_lock:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.close(os.open(PUBLISH_MANIFEST_LOCK_PATH,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                pass
+
+            try:
+                mtime = os.path.getmtime(PUBLISH_MANIFEST_LOCK_PATH)
+                if time.time() - mtime > stale_after:
+                    logging.warning('Breaking stale publish manifest lock')
+                    os.unlink(PUBLISH_MANIFEST_LOCK_PATH)
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if time.monotonic() > deadline:
+                raise TimeoutError('Could not lock the publish manifest at '
+                                   f'{PUBLISH_MANIFEST_LOCK_PATH}')
+            time.sleep(0.1)
+
+        try:
+            yield
+        finally:
+            try:
+                os.unlink(PUBLISH_MANIFEST_LOCK_PATH)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,122 @@
+"""Waits
+Condition-based waits for cyschoolhouse pages, to use in place of fixed
+sleeps. A wait returns as soon as the page is ready and gives up after its
+timeout, and every wait records how long it took under a name, so slow steps
+can be found with `latency_report()`.
+
+    wait_page_settled(driver, 'section.school')
+    wait_for(driver, EC.element_to_be_clickable(locator), 'ia.save')
+"""
+import logging
+import threading
+from collections import defaultdict
+from time import monotonic
+
+import pandas as pd
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+DEFAULT_TIMEOUT = 30
+
+# Salesforce Classic pages use jQuery and Visualforce's A4J for partial
+# page updates; either may be absent from a given page
+_AJAX_IDLE_JS = """
+return document.readyState === 'complete'
+    && (typeof jQuery === 'undefined' || jQuery.active === 0)
+    && (typeof A4J === 'undefined' || !A4J.AJAX || !A4J.AJAX._requestsQueues
+        || Object.keys(A4J.AJAX._requestsQueues).every(
+               function (k) { return !A4J.AJAX._requestsQueues[k]; }));
+"""
+
+# Installs a MutationObserver on first use and returns the milliseconds
+# since the DOM last changed
+_DOM_QUIET_JS = """
+if (!window.__cyshObserver) {
+    window.__cyshLastMutation = Date.now();
+    window.__cyshObserver = new MutationObserver(function () {
+        window.__cyshLastMutation = Date.now();
+    });
+    window.__cyshObserver.observe(document, {
+        subtree: true, childList: true, attributes: true, characterData: true
+    });
+}
+return Date.now() - window.__cyshLastMutation;
+"""
+
+_latencies = defaultdict(list)
+_lock = threading.Lock()
+
+
+class ajax_idle:
+    """Condition: the page has loaded and no AJAX requests are in flight"""
+
+    def __call__(self, driver):
+        return bool(driver.execute_script(_AJAX_IDLE_JS))
+
+
+class dom_quiet:
+    """Condition: the DOM has not changed for `quiet` seconds"""
+
+    def __init__(self, quiet=0.3):
+        self.quiet = quiet
+
+    def __call__(self, driver):
+        return driver.execute_script(_DOM_QUIET_JS) >= self.quiet * 1000
+
+
+def wait_for(driver, condition, name, timeout=DEFAULT_TIMEOUT,
+             poll_frequency=0.1):
+    """ Waits until `condition(driver)` is truthy and returns its value.
+    The time taken is recorded under `name`.
+    """
+    start = monotonic()
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency).until(condition)
+    except TimeoutException:
+        logging.warning(f'Wait for {name} timed out after {timeout}s')
+        raise
+    finally:
+        record(name, monotonic() - start)
+
+
+def wait_ajax_idle(driver, name, timeout=DEFAULT_TIMEOUT):
+    return wait_for(driver, ajax_idle(), name, timeout)
+
+
+def wait_dom_quiet(driver, name, quiet=0.3, timeout=DEFAULT_TIMEOUT):
+    return wait_for(driver, dom_quiet(quiet), name, timeout)
+
+
+def wait_page_settled(driver, name, quiet=0.3, timeout=DEFAULT_TIMEOUT):
+    """ Waits for AJAX to finish and then for the DOM to stop changing,
+    which covers the re-renders that follow a dropdown or button.
+    """
+    def settled(driver):
+        return ajax_idle()(driver) and dom_quiet(quiet)(driver)
+
+    return wait_for(driver, settled, name, timeout)
+
+
+def record(name, seconds):
+    with _lock:
+        _latencies[name].append(seconds)
+
+
+def reset_latencies():
+    with _lock:
+        _latencies.clear()
+
+
+def latency_report():
+    """ Returns count, mean, median, 95th percentile and max seconds of the
+    waits recorded so far, one row per wait name, slowest first.
+    """
+    with _lock:
+        rows = [(name, seconds) for name, values in _latencies.items()
+                for seconds in values]
+
+    df = pd.DataFrame(rows, columns=['wait', 'seconds'])
+    return (df.groupby('wait')['seconds']
+              .agg(count='count', mean='mean', median='median',
+                   p95=lambda x: x.quantile(0.95), max='max')
+              .sort_values('mean', ascending=False))